@@ -2,6 +2,7 @@ import argparse
 import os
 import json
 import pprint
+import sys
 
 import prettytable
 
@@ -33,6 +34,20 @@ collection_headers = \
         ]
     }
 
+# Longer cells are cut to fit; status fits "deploy->inconsistent"
+column_widths = \
+    {
+        "uuid": 36,
+        "name": 44,
+        "tag": 20,
+        "set_name": 16,
+        "status": 20,
+        "tests": 8,
+        "errors": 8,
+        "failures": 8,
+        "created_at": 26,
+    }
+
 resource_fields = \
     {
         "deployment": [
@@ -64,7 +79,9 @@ resource_fields = \
             "time",
             "created_at",
             "updated_at",
-            "deployment_uuid"]
+            "deployment_uuid",
+            "rerun_of",
+            "rerun_params"]
     }
 
 class Struct(object):
@@ -83,6 +100,36 @@ def print_collection_table(collection_name, collection_list):
     print table
 
 
+def fit_cell(value, width):
+    """Pad a table cell to the column width, cutting it if it is longer."""
+    value = unicode(value)
+    if len(value) > width:
+        value = value[:width - 3] + u"..."
+    return value.ljust(width)
+
+
+def print_collection_stream(collection_name, collection):
+    """Print a table row by row, as soon as each resource arrives."""
+    headers = collection_headers[collection_name]
+    widths = [max(len(header), column_widths.get(header, 0))
+              for header in headers]
+    border = "+" + "+".join("-" * (width + 2) for width in widths) + "+"
+
+    def print_row(values):
+        cells = [fit_cell(value, width)
+                 for value, width in zip(values, widths)]
+        sys.stdout.write(
+            (u"| " + u" | ".join(cells) + u" |\n").encode("utf-8"))
+        sys.stdout.flush()
+
+    print border
+    print_row(headers)
+    print border
+    for resource in collection:
+        print_row([resource.get(field, "") for field in headers])
+    print border
+
+
 def print_resource_table(resource_name, resource):
     fields = resource_fields[resource_name]
     resource_headers = ["Property", "Value"]
@@ -101,11 +148,37 @@ def parse_args(client):
         description="Rallyd control utility", prog="rallyd-cmd")
     parser.add_argument(
         "--endpoint", help="rallyd endpoint", default="http://127.0.0.1:10000")
-    parser.add_argument(
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument(
         "--json", help="Print pure-json output", action="store_true")
+    output.add_argument(
+        "--json-lines", action="store_true",
+        help="Print json output, one line per listed resource")
+    parser.add_argument(
+        "--cache-dir", default="~/.cache/rallyd",
+        help="Directory keeping finished tasks and verifications")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Always fetch tasks and verifications from rallyd")
+    parser.add_argument(
+        "--dedupe-by-body", action="store_true",
+        help="Derive submission Idempotency-Keys from the request body, "
+             "so repeating a command doesn't start the job twice")
 
     subparsers = parser.add_subparsers()
 
+    get_readiness = subparsers.add_parser(
+        'ready', help='Check whether rallyd finished loading Rally')
+    get_readiness.set_defaults(func=client.get_readiness)
+
+    get_health = subparsers.add_parser(
+        'health', help='Print rallyd load and running jobs')
+    get_health.set_defaults(func=client.get_health)
+
+    get_startup_report = subparsers.add_parser(
+        'startup-report', help='Print rallyd startup timings')
+    get_startup_report.set_defaults(func=client.get_startup_report)
+
     recreate_db = subparsers.add_parser(
         'recreate-db', help='Recreate Rally database')
     recreate_db.set_defaults(func=client.recreate_db)
@@ -131,16 +204,19 @@ def parse_args(client):
     list_deployments.set_defaults(func=client.list_deployments)
 
     def start_task(task_filename, task_params,
-                   tag, deployment_uuid, abort_on_sla_failure):
+                   tag, deployment_uuid, abort_on_sla_failure,
+                   idempotency_key):
         if task_params is not None:
             return client.create_task(
                 open(task_filename).read(),
                 task_params=open(task_params).read(),
                 tag=tag, deployment_uuid=deployment_uuid,
-                abort_on_sla_failure=abort_on_sla_failure)
+                abort_on_sla_failure=abort_on_sla_failure,
+                idempotency_key=idempotency_key)
         return client.create_task(open(task_filename).read(),
                                   tag=tag, deployment_uuid=deployment_uuid,
-                                  abort_on_sla_failure=abort_on_sla_failure)
+                                  abort_on_sla_failure=abort_on_sla_failure,
+                                  idempotency_key=idempotency_key)
 
     create_task = subparsers.add_parser(
         "task-create", help="Start new rally task")
@@ -155,11 +231,17 @@ def parse_args(client):
     create_task.add_argument(
         "--abort-on-sla-failure", action="store_true",
         help="Abort task on SLA failure")
+    create_task.add_argument(
+        "--idempotency-key",
+        help="Key to run the submission only once across retries")
     create_task.set_defaults(func=start_task)
 
     list_tasks = subparsers.add_parser(
         "task-list", help="List Rally tasks")
-    list_tasks.set_defaults(func=client.list_tasks)
+    list_tasks.add_argument(
+        "--page-size", type=int, help="Number of tasks fetched at once",
+        default=100)
+    list_tasks.set_defaults(func=client.iter_tasks, collection="tasks")
 
     get_task = subparsers.add_parser(
         "task-get", help="Print Rally task info")
@@ -167,6 +249,12 @@ def parse_args(client):
         "task_uuid", help="UUID of Rally task")
     get_task.set_defaults(func=client.get_task)
 
+    get_task_progress = subparsers.add_parser(
+        "task-progress", help="Print progress of running Rally task")
+    get_task_progress.add_argument(
+        "task_uuid", help="UUID of Rally task")
+    get_task_progress.set_defaults(func=client.get_task_progress)
+
     get_task_log = subparsers.add_parser(
         "task-log", help="Print log of Rally task")
     get_task_log.add_argument(
@@ -185,6 +273,34 @@ def parse_args(client):
         "--download-dir", help="Directory for downloading", default=".")
     get_task_result.set_defaults(func=client.get_task_result)
 
+    get_task_data = subparsers.add_parser(
+        "task-data", help="Print task duration statistics")
+    get_task_data.add_argument(
+        "task_uuid", help="UUID of Rally task")
+    get_task_data.add_argument(
+        "--points", type=int,
+        help="Number of points in downsampled duration series")
+    get_task_data.set_defaults(func=client.get_task_data)
+
+    compare_tasks = subparsers.add_parser(
+        "task-compare", help="Compare duration statistics of tasks")
+    compare_tasks.add_argument(
+        "task_uuids", nargs="+",
+        help="UUIDs of Rally tasks, the first one is the baseline")
+    compare_tasks.set_defaults(func=client.compare_tasks)
+
+    get_task_trend = subparsers.add_parser(
+        "task-trend", help="Print duration trend of tasks with tag")
+    get_task_trend.add_argument(
+        "tag", help="Tag of Rally tasks")
+    get_task_trend.add_argument(
+        "--stat", help="Statistic to follow",
+        choices=["min", "median", "p90", "p95", "max", "avg"],
+        default="p95")
+    get_task_trend.add_argument(
+        "--limit", type=int, help="Number of latest tasks", default=30)
+    get_task_trend.set_defaults(func=client.get_task_trend)
+
     get_task_report = subparsers.add_parser(
         "task-report", help="Download task report")
     get_task_report.add_argument(
@@ -196,12 +312,24 @@ def parse_args(client):
         "--download-dir", help="Directory for downloading", default=".")
     get_task_report.set_defaults(func=client.get_task_report)
 
+    abort_task = subparsers.add_parser(
+        "task-abort", help="Abort running Rally task")
+    abort_task.add_argument(
+        "task_uuid", help="UUID of Rally task")
+    abort_task.add_argument(
+        "--soft", action="store_true",
+        help="Let running iterations finish")
+    abort_task.set_defaults(func=client.abort_task)
+
     install_tempest = subparsers.add_parser(
         "tempest-install", help="Install tempest for deployment")
     install_tempest.add_argument(
         "deployment_uuid", help="Deployment UUID")
     install_tempest.add_argument(
         "--tempest-source", help="Source for tempest installation")
+    install_tempest.add_argument(
+        "--idempotency-key",
+        help="Key to run the submission only once across retries")
     install_tempest.set_defaults(func=client.install_tempest)
 
     check_tempest = subparsers.add_parser(
@@ -233,11 +361,40 @@ def parse_args(client):
         "--tempest-config", help="Path to custom tempest config")
     run_verification.add_argument(
         "--concurrency", type=int, help="Number of threads to run", default=1)
+    run_verification.add_argument(
+        "--idempotency-key",
+        help="Key to run the submission only once across retries")
     run_verification.set_defaults(func=client.run_verification)
 
+    rerun_verification = subparsers.add_parser(
+        "verification-rerun", help="Re-run failed tests of tempest run")
+    rerun_verification.add_argument(
+        "verification_uuid", help="UUID of verification run")
+    rerun_verification.add_argument(
+        "--tests", nargs="+",
+        help="Test ids to run instead of the failed ones")
+    rerun_verification.add_argument(
+        "--tempest-config", help="Path to custom tempest config")
+    rerun_verification.add_argument(
+        "--concurrency", type=int, help="Number of threads to run")
+    rerun_verification.set_defaults(func=client.rerun_verification)
+
+    abort_verification = subparsers.add_parser(
+        "verification-abort", help="Abort running tempest run")
+    abort_verification.add_argument(
+        "verification_uuid", help="UUID of verification run")
+    abort_verification.add_argument(
+        "--soft", action="store_true",
+        help="Interrupt tempest instead of killing it")
+    abort_verification.set_defaults(func=client.abort_verification)
+
     list_verifications = subparsers.add_parser(
         "verification-list", help="List all verifications")
-    list_verifications.set_defaults(func=client.list_verifications)
+    list_verifications.add_argument(
+        "--page-size", type=int,
+        help="Number of verifications fetched at once", default=100)
+    list_verifications.set_defaults(func=client.iter_verifications,
+                                    collection="verifications")
 
     get_verification = subparsers.add_parser(
         "verification-get", help="Get specific tempest run")
@@ -254,6 +411,31 @@ def parse_args(client):
         help="Enable verbose raw json output")
     get_verification_result.set_defaults(func=client.get_verification_result)
 
+    diff_verifications = subparsers.add_parser(
+        "verification-diff", help="Compare results of two tempest runs")
+    diff_verifications.add_argument(
+        "verification_uuid", help="UUID of base verification run")
+    diff_verifications.add_argument(
+        "other_uuid", help="UUID of verification run to compare with")
+    diff_verifications.set_defaults(func=client.diff_verifications)
+
+    get_flaky_tests = subparsers.add_parser(
+        "verification-flaky", help="List flaky tempest tests of deployment")
+    get_flaky_tests.add_argument(
+        "deployment_uuid", help="Deployment UUID")
+    get_flaky_tests.add_argument(
+        "--limit", type=int, help="Number of tests to list", default=20)
+    get_flaky_tests.set_defaults(func=client.get_flaky_tests)
+
+    get_slowest_tests = subparsers.add_parser(
+        "verification-slowest",
+        help="List slowest tempest tests of deployment")
+    get_slowest_tests.add_argument(
+        "deployment_uuid", help="Deployment UUID")
+    get_slowest_tests.add_argument(
+        "--limit", type=int, help="Number of tests to list", default=20)
+    get_slowest_tests.set_defaults(func=client.get_slowest_tests)
+
     get_verification_report = subparsers.add_parser(
         "verification-report", help="Download tempest run report")
     get_verification_report.add_argument(
@@ -275,11 +457,28 @@ def main():
     args = vars(parse_args(rallyd_client))
 
     command = args.pop("func")
+    collection = args.pop("collection", None)
     json_enabled = args.pop("json")
+    json_lines_enabled = args.pop("json_lines")
     rallyd_client.set_base_url(args.pop("endpoint"))
+    cache_dir = args.pop("cache_dir")
+    if not args.pop("no_cache"):
+        rallyd_client.set_cache_dir(os.path.expanduser(cache_dir))
+    rallyd_client.set_body_idempotency_keys(args.pop("dedupe_by_body"))
     result = command(**args)
 
-    if json_enabled:
+    if collection is not None:
+        if json_enabled:
+            print json.dumps({collection: list(result)})
+        elif json_lines_enabled:
+            for resource in result:
+                print json.dumps(resource)
+                sys.stdout.flush()
+        else:
+            print_collection_stream(collection, result)
+        return
+
+    if json_enabled or json_lines_enabled:
         print json.dumps(result)
         return
 
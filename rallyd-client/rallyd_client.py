@@ -1,25 +1,113 @@
 #!/usr/bin/python
 
+import hashlib
 import json
 import os
+import random
+import tempfile
+import time
 import urlparse
+import uuid
 
 import requests
 
 
+FINAL_STATUSES = ("finished", "failed", "aborted")
+
+
 class RallydClient(object):
-    def __init__(self, base_url=None):
+    def __init__(self, base_url=None, max_retries=5, max_backoff=300,
+                 cache_dir=None, body_idempotency_keys=False):
         self.base_url = base_url
         self.session = requests.Session()
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.cache_dir = cache_dir
+        self.body_idempotency_keys = body_idempotency_keys
 
     def set_base_url(self, base_url):
         self.base_url = base_url
 
+    def set_cache_dir(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def set_body_idempotency_keys(self, body_idempotency_keys):
+        self.body_idempotency_keys = body_idempotency_keys
+
+    def cache_path(self, resource_name, resource_uuid):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir,
+                            "{0}_{1}.json".format(resource_name,
+                                                  resource_uuid))
+
+    def cached_get(self, resource_name, resource_uuid, url):
+        """Get a resource, keeping it on disk once it is finished."""
+        path = self.cache_path(resource_name, resource_uuid)
+        if path is not None and os.path.exists(path):
+            with open(path) as cached:
+                return json.load(cached)
+
+        headers, body = self.get(url)
+        if (path is not None and isinstance(body, dict) and
+                body[resource_name]["status"] in FINAL_STATUSES):
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, "w") as cached:
+                json.dump(body, cached)
+            os.rename(tmp_path, path)
+        return body
+
+    def iter_collection(self, url, collection_name, page_size):
+        """Yield items of a collection fetching it page by page."""
+        offset = 0
+        previous_page = None
+        while True:
+            headers, body = self.get(url, params={"limit": page_size,
+                                                  "offset": offset})
+            page = body[collection_name]
+            # Servers without paging return everything for every page
+            if page == previous_page:
+                return
+            for item in page:
+                yield item
+            if len(page) != page_size:
+                return
+            previous_page = page
+            offset += page_size
+
     def request(self, url, method, headers=None, body=None, **kwargs):
-        if headers is None:
-            headers = {'Content-Type': 'application/json'}
-        r = requests.request(method, urlparse.urljoin(self.base_url, url),
-                             headers=headers, data=body, **kwargs)
+        headers = dict(headers or {})
+        headers.setdefault('Content-Type', 'application/json')
+
+        # rallyd rejects jobs with 429/503 and Retry-After when it is busy.
+        # Requests with an Idempotency-Key are also repeated when they
+        # may or may not have reached rallyd, as it runs them only once.
+        keyed = 'Idempotency-Key' in headers
+        for attempt in range(self.max_retries + 1):
+            try:
+                r = requests.request(method,
+                                     urlparse.urljoin(self.base_url, url),
+                                     headers=headers, data=body, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not keyed or attempt == self.max_retries:
+                    raise
+                retry_after = 0
+            else:
+                retry_after = r.headers.get('Retry-After')
+                if keyed and r.status_code in (502, 504):
+                    retry_after = retry_after or 0
+                elif r.status_code not in (429, 503) or retry_after is None:
+                    break
+                if attempt == self.max_retries:
+                    raise requests.HTTPError(r.content)
+            try:
+                retry_after = int(retry_after)
+            except ValueError:
+                retry_after = 0
+            time.sleep(min(max(retry_after, 2 ** attempt), self.max_backoff) +
+                       random.uniform(0, 1))
 
         if r.headers.get('Content-Type') == 'application/json':
             body = json.loads(r.content)
@@ -43,6 +131,18 @@ class RallydClient(object):
     def delete(self, url, **kwargs):
         return self.request(url, "DELETE", **kwargs)
 
+    def get_readiness(self):
+        headers, body = self.get("/ready")
+        return body
+
+    def get_health(self):
+        headers, body = self.get("/health")
+        return body
+
+    def get_startup_report(self):
+        headers, body = self.get("/startup")
+        return body
+
     def recreate_db(self, **kwargs):
         headers, body = self.post("/db")
         return body
@@ -74,8 +174,20 @@ class RallydClient(object):
             self.delete("/deployments/{0}".format(deployment_uuid))
         return body
 
+    def idempotency_headers(self, request, idempotency_key=None):
+        # Retries of the same call reuse the key, so rallyd runs it once.
+        # With body keys, repeated calls with the same body do too.
+        if idempotency_key is None:
+            if self.body_idempotency_keys:
+                idempotency_key = hashlib.sha1(
+                    json.dumps(request, sort_keys=True)).hexdigest()
+            else:
+                idempotency_key = str(uuid.uuid4())
+        return {"Idempotency-Key": idempotency_key}
+
     def create_task(self, task, task_params=None, tag=None,
-                    deployment_uuid=None, abort_on_sla_failure=False):
+                    deployment_uuid=None, abort_on_sla_failure=False,
+                    idempotency_key=None):
         request = {
             "task_config": task,
             "tag": tag,
@@ -86,15 +198,36 @@ class RallydClient(object):
             task_params = json.loads(task_params)
             request.update({"task_params": task_params})
 
-        headers, body = self.post("/tasks", body=request)
+        headers, body = self.post(
+            "/tasks", body=request,
+            headers=self.idempotency_headers(request, idempotency_key))
         return body
 
     def list_tasks(self):
         headers, body = self.get("/tasks")
         return body
 
+    def compare_tasks(self, task_uuids):
+        headers, body = self.get("/tasks/compare",
+                                 params={"uuids": ",".join(task_uuids)})
+        return body
+
+    def get_task_trend(self, tag, stat="p95", limit=30):
+        headers, body = self.get("/tasks/trend",
+                                 params={"tag": tag,
+                                         "stat": stat,
+                                         "limit": limit})
+        return body
+
+    def iter_tasks(self, page_size=100):
+        return self.iter_collection("/tasks", "tasks", page_size)
+
     def get_task(self, task_uuid):
-        headers, body = self.get("/tasks/{0}".format(task_uuid))
+        return self.cached_get("task", task_uuid,
+                               "/tasks/{0}".format(task_uuid))
+
+    def get_task_progress(self, task_uuid):
+        headers, body = self.get("/tasks/{0}/progress".format(task_uuid))
         return body
 
     def get_task_log(self, task_uuid, start_line=-10, end_line=None):
@@ -114,6 +247,14 @@ class RallydClient(object):
             result.write(body)
         return "Downloaded: {0}".format(path)
 
+    def get_task_data(self, task_uuid, points=None):
+        payload = {}
+        if points is not None:
+            payload.update({"points": points})
+        headers, body = self.get("/tasks/{0}/data".format(task_uuid),
+                                 params=payload)
+        return body
+
     def get_task_report(self, task_uuid,
                         report_format='html',
                         download_dir="."):
@@ -126,15 +267,29 @@ class RallydClient(object):
             result.write(body)
         return "Downloaded: {0}".format(path)
 
+    def abort_task(self, task_uuid, soft=False):
+        payload = {}
+        if soft:
+            payload.update({"soft": 1})
+        headers, body = self.post("/tasks/{0}/abort".format(task_uuid),
+                                  params=payload)
+        return body
+
     def delete_task(self, task_uuid):
+        path = self.cache_path("task", task_uuid)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
         headers, body = self.delete("/tasks/{0}".format(task_uuid))
         return body
 
-    def install_tempest(self, deployment_uuid=None, tempest_source=None):
+    def install_tempest(self, deployment_uuid=None, tempest_source=None,
+                        idempotency_key=None):
         request = {"tempest_source": tempest_source}
         headers, body = \
             self.post("/deployments/{0}/tempest".format(deployment_uuid),
-                      body=request)
+                      body=request,
+                      headers=self.idempotency_headers(request,
+                                                       idempotency_key))
         return body
 
     def check_tempest(self, deployment_uuid):
@@ -153,24 +308,56 @@ class RallydClient(object):
         return body
 
     def run_verification(self, deployment_uuid, set_name=None,
-                         regex=None, tempest_config=None, concurrency=1):
+                         regex=None, tempest_config=None, concurrency=1,
+                         idempotency_key=None):
         request = {
             "deployment_uuid": deployment_uuid,
             "set_name": set_name,
             "regex": regex,
             "tempest_config": tempest_config,
             "concurrency": concurrency}
-        headers, body = self.post("/verifications", body=request)
+        headers, body = self.post(
+            "/verifications", body=request,
+            headers=self.idempotency_headers(request, idempotency_key))
+        return body
+
+    def rerun_verification(self, verification_uuid, tests=None,
+                           tempest_config=None, concurrency=None,
+                           idempotency_key=None):
+        request = {}
+        if tests:
+            request.update({"tests": tests})
+        if tempest_config is not None:
+            request.update({"tempest_config": tempest_config})
+        if concurrency is not None:
+            request.update({"concurrency": concurrency})
+        headers, body = self.post(
+            "/verifications/{0}/rerun".format(verification_uuid),
+            body=request,
+            headers=self.idempotency_headers(request, idempotency_key))
+        return body
+
+    def abort_verification(self, verification_uuid, soft=False):
+        payload = {}
+        if soft:
+            payload.update({"soft": 1})
+        headers, body = self.post(
+            "/verifications/{0}/abort".format(verification_uuid),
+            params=payload)
         return body
 
     def list_verifications(self):
         headers, body = self.get("/verifications")
         return body
 
+    def iter_verifications(self, page_size=100):
+        return self.iter_collection("/verifications", "verifications",
+                                    page_size)
+
     def get_verification(self, verification_uuid):
-        headers, body = \
-            self.get("/verifications/{0}".format(verification_uuid))
-        return body
+        return self.cached_get(
+            "verification", verification_uuid,
+            "/verifications/{0}".format(verification_uuid))
 
     def get_verification_result(self, verification_uuid, detailed=False):
         payload = {}
@@ -182,6 +369,23 @@ class RallydClient(object):
                      params=payload)
         return body
 
+    def diff_verifications(self, verification_uuid, other_uuid):
+        headers, body = self.get("/verifications/{0}/diff/{1}".format(
+            verification_uuid, other_uuid))
+        return body
+
+    def get_flaky_tests(self, deployment_uuid, limit=20):
+        headers, body = self.get(
+            "/deployments/{0}/verifications/flaky".format(deployment_uuid),
+            params={"limit": limit})
+        return body
+
+    def get_slowest_tests(self, deployment_uuid, limit=20):
+        headers, body = self.get(
+            "/deployments/{0}/verifications/slowest".format(deployment_uuid),
+            params={"limit": limit})
+        return body
+
     def get_verification_report(self, verification_uuid, report_format='html',
                                 download_dir="."):
         payload = {"report_format": report_format}
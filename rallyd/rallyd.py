@@ -1,25 +1,135 @@
 #!/usr/bin/python
 
+import bisect
+import collections
+import contextlib
 import json
 import datetime
-import subprocess
+import errno
+import functools
+import hashlib
+import heapq
+import importlib
 import sys
 import os
 import logging
+import multiprocessing
+import pipes
+import re
+import signal
+import SocketServer
+import sqlite3
+import subprocess
+import tempfile
 import threading
+import time
 import uuid
 import urllib
+import warnings
+
+STARTED_AT = time.time()
 
 import flask
 import jinja2
 from oslo_config import cfg
-from rally import api
-from rally.cli.commands import task as task_cli
-from rally.common import db
-from rally.common import objects
-from rally import plugins
-from rally.verification.tempest import tempest
-from rally.verification.tempest import json2html
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+LOG = logging.getLogger("rallyd")
+
+
+class StackLoader(object):
+    """Imports heavy modules, parses config and loads Rally plugins.
+
+    Everything is loaded once, either on first use of a LazyModule or by
+    the background warm-up in lazy mode. Rally registers its own CLI
+    options on import, so the config is parsed only after the imports.
+    """
+
+    def __init__(self, modules):
+        self.modules = modules
+        self.lock = threading.Lock()
+        self.status = "cold"
+        self.timings = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        started_at = time.time()
+        yield
+        self.timings[name] = time.time() - started_at
+
+    def load(self):
+        if self.status == "ready":
+            return
+        with self.lock:
+            if self.status == "ready":
+                return
+            self.status = "warming"
+            try:
+                for name in self.modules:
+                    with self.timer(name):
+                        importlib.import_module(name)
+                with self.timer("config"):
+                    CONF(sys.argv[1:], project="rally")
+                    configure_database()
+                with self.timer("plugins"):
+                    importlib.import_module("rally.plugins").load()
+                    install_progress_hooks()
+            except Exception:
+                self.status = "failed"
+                raise
+            self.status = "ready"
+
+    def warm_up(self):
+        try:
+            self.load()
+        except Exception:
+            LOG.exception("Failed to load Rally")
+        else:
+            LOG.info("Rally loaded in %.2fs", sum(self.timings.values()))
+
+
+class LazyModule(object):
+    """Module proxy which makes the loader load everything on first use."""
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+
+    def __getattr__(self, attr):
+        module = self.__dict__.get("module")
+        if module is None:
+            self.loader.load()
+            module = self.module = importlib.import_module(self.name)
+        return getattr(module, attr)
+
+
+LOADER = StackLoader(["numpy",
+                      "rally.api",
+                      "rally.consts",
+                      "rally.exceptions",
+                      "rally.cli.commands.task",
+                      "rally.cli.envutils",
+                      "rally.common.db",
+                      "rally.common.db.sqlalchemy.models",
+                      "rally.common.objects",
+                      "rally.plugins",
+                      "rally.verification.tempest.tempest",
+                      "rally.verification.tempest.json2html"])
+np = LazyModule("numpy", LOADER)
+api = LazyModule("rally.api", LOADER)
+consts = LazyModule("rally.consts", LOADER)
+exceptions = LazyModule("rally.exceptions", LOADER)
+task_cli = LazyModule("rally.cli.commands.task", LOADER)
+envutils = LazyModule("rally.cli.envutils", LOADER)
+db = LazyModule("rally.common.db", LOADER)
+db_models = LazyModule("rally.common.db.sqlalchemy.models", LOADER)
+objects = LazyModule("rally.common.objects", LOADER)
+tempest = LazyModule("rally.verification.tempest.tempest", LOADER)
+json2html = LazyModule("rally.verification.tempest.json2html", LOADER)
 
 
 class Rallyd(flask.Flask):
@@ -35,25 +145,754 @@ class DateJSONEncoder(flask.json.JSONEncoder):
         return flask.json.JSONEncoder.default(self, obj)
 
 
-class Tee(object):
-    def __init__(self, name, mode):
-        self.file = open(name, mode)
-        self.stdout = sys.stdout
-        sys.stdout = self
+class ThreadLocalStdout(object):
+    """sys.stdout replacement which routes writes per thread.
+
+    Rally CLI commands and the tempest verifier print straight to
+    sys.stdout. Instead of swapping the process-wide stream for every
+    request, each thread redirects only its own output.
+    """
 
-    def __del__(self):
-        sys.stdout = self.stdout
-        self.file.close()
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def redirect(self, stream, tee=False):
+        saved = (getattr(self.local, "stream", None),
+                 getattr(self.local, "tee", False))
+        self.local.stream, self.local.tee = stream, tee
+        try:
+            yield stream
+        finally:
+            self.local.stream, self.local.tee = saved
 
     def write(self, data):
-        self.file.write(data)
-        self.stdout.write(data)
-        self.file.flush()
+        stream = getattr(self.local, "stream", None)
+        if stream is None:
+            self.stdout.write(data)
+            return
+        stream.write(data)
+        stream.flush()
+        if self.local.tee:
+            self.stdout.write(data)
+
+    def flush(self):
+        stream = getattr(self.local, "stream", None)
+        if stream is not None:
+            stream.flush()
+        self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+class LRUCache(object):
+    """Thread-safe mapping which keeps only recently used items.
+
+    With ttl set, items also expire that many seconds after being set.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires_at, value = self.items.pop(key)
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at < time.time():
+                return default
+            self.items[key] = expires_at, value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.ttl if self.ttl else None,
+                               value)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class ResponseCache(object):
+    """Serialized responses which no longer change.
+
+    Responses are kept in an in-process LRU cache or, when [rallyd]
+    cache_servers is set, only in memcached, so that rallyd nodes see
+    each other's invalidations. Shared keys carry a generation of the
+    namespace, which is bumped to clear it. Size and TTL come from the
+    given [rallyd] options.
+    """
+
+    def __init__(self, namespace, size_option="cache_size",
+                 ttl_option="cache_ttl"):
+        self.namespace = namespace
+        self.size_option = size_option
+        self.ttl_option = ttl_option
+        self.ready = False
+        self.local = None
+        self.shared = None
+        self.lock = threading.Lock()
+
+    def setup(self):
+        if self.ready:
+            return
+        # Options are only parsed once the loader is done
+        LOADER.load()
+        with self.lock:
+            if self.ready:
+                return
+            self.ttl = getattr(CONF.rallyd, self.ttl_option)
+            if CONF.rallyd.cache_servers:
+                if memcache is None:
+                    LOG.warning("python-memcached is not installed, "
+                                "responses are cached per process only")
+                else:
+                    self.shared = memcache.Client(CONF.rallyd.cache_servers)
+            if self.shared is None:
+                self.local = LRUCache(getattr(CONF.rallyd, self.size_option),
+                                      self.ttl)
+            self.ready = True
+
+    def generation_key(self):
+        return "rallyd:{0}:generation".format(self.namespace)
+
+    def shared_key(self, key):
+        generation = self.shared.get(self.generation_key())
+        if generation is None:
+            # Counting from the clock, a lost counter never brings
+            # back an older generation
+            self.shared.add(self.generation_key(), int(time.time()))
+            generation = self.shared.get(self.generation_key())
+        return "rallyd:{0}:{1}:{2}".format(self.namespace, generation, key)
+
+    def get(self, key):
+        self.setup()
+        if self.shared is not None:
+            return self.shared.get(self.shared_key(key))
+        return self.local.get(key)
+
+    def set(self, key, value):
+        self.setup()
+        if self.shared is not None:
+            self.shared.set(self.shared_key(key), value, time=self.ttl)
+        else:
+            self.local.set(key, value)
+
+    def delete(self, *keys):
+        self.setup()
+        for key in keys:
+            if self.shared is not None:
+                self.shared.delete(self.shared_key(key))
+            else:
+                self.local.delete(key)
+
+    def reserve(self, key, ttl):
+        """Claim a key for ttl seconds, False if another node holds it.
+
+        Without shared servers there is no other node to ask.
+        """
+        self.setup()
+        if self.shared is None:
+            return True
+        return bool(self.shared.add(self.shared_key("reserved:" + key),
+                                    1, time=ttl))
+
+    def unreserve(self, key):
+        self.setup()
+        if self.shared is not None:
+            self.shared.delete(self.shared_key("reserved:" + key))
+
+    def clear(self):
+        self.setup()
+        if self.shared is None:
+            self.local.clear()
+        elif self.shared.incr(self.generation_key()) is None:
+            self.shared.add(self.generation_key(), int(time.time()))
+
+
+TaskAggregate = collections.namedtuple("TaskAggregate", ["labels", "stats"])
+
+
+class ScenarioProgress(object):
+    """Iteration counters of a single scenario run.
+
+    Completions are counted per second over the last RATE_WINDOW
+    seconds, so a snapshot costs the same however long the run is.
+    """
+
+    RATE_WINDOW = 10
+
+    def __init__(self, name, runner_config):
+        self.name = name
+        self.total = runner_config.get("times")
+        self.duration = runner_config.get("duration")
+        self.started_at = None
+        self.finished_at = None
+        self.completed = 0
+        self.errors = 0
+        self.window = collections.deque(maxlen=self.RATE_WINDOW)
+
+    def start(self, runner_config):
+        self.total = runner_config.get("times", self.total)
+        self.duration = runner_config.get("duration", self.duration)
+        self.started_at = time.time()
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def add(self, result):
+        second = int(time.time())
+        if self.window and self.window[-1][0] == second:
+            self.window[-1][1] += 1
+        else:
+            self.window.append([second, 1])
+        self.completed += 1
+        if result.get("error"):
+            self.errors += 1
+
+    def snapshot(self, now):
+        status, rate, eta = "pending", None, None
+        if self.finished_at is not None:
+            status, eta = "finished", 0
+            elapsed = self.finished_at - self.started_at
+            rate = self.completed / elapsed if elapsed > 0 else None
+        elif self.started_at is not None:
+            status = "running"
+            elapsed = min(self.RATE_WINDOW, now - self.started_at)
+            recent = sum(count for second, count in list(self.window)
+                         if second > now - self.RATE_WINDOW)
+            rate = recent / elapsed if elapsed > 0 else None
+            if self.total and rate:
+                eta = max(0, self.total - self.completed) / rate
+            elif self.duration:
+                eta = max(0, self.started_at + self.duration - now)
+
+        return {"name": self.name,
+                "status": status,
+                "completed": self.completed,
+                "total": self.total,
+                "errors": self.errors,
+                "error_rate": (self.errors * 100.0 / self.completed
+                               if self.completed else None),
+                "iterations_per_second": rate,
+                "eta": eta}
+
+
+class TaskProgress(object):
+    """Progress of the scenarios of a task, in the order of its config."""
+
+    def __init__(self, config):
+        self.lock = threading.Lock()
+        self.scenarios = [ScenarioProgress(name, runner_config)
+                          for name, runner_config in self.workloads(config)]
+
+    @staticmethod
+    def workloads(config):
+        """Yield scenario name and runner config of every workload.
+
+        Version 2 tasks list workloads in subtasks, a subtask itself
+        being the workload if it has no list, and key runner configs by
+        runner type; in version 1 tasks scenario names are the keys.
+        """
+        if config.get("version") == 2:
+            for subtask in config.get("subtasks") or []:
+                for workload in subtask.get("workloads") or [subtask]:
+                    runner_config = workload.get("runner") or {}
+                    if "type" not in runner_config and len(runner_config) == 1:
+                        runner_config = runner_config.values()[0]
+                    for name in workload.get("scenario") or {}:
+                        yield name, runner_config
+            return
+
+        for name, workloads in sorted(config.items()):
+            if isinstance(workloads, list):
+                for workload in workloads:
+                    yield name, workload.get("runner") or {}
+
+    def start(self, name, runner_config):
+        with self.lock:
+            for scenario in self.scenarios:
+                if scenario.name == name and scenario.started_at is None:
+                    break
+            else:
+                scenario = ScenarioProgress(name, runner_config)
+                self.scenarios.append(scenario)
+            scenario.start(runner_config)
+        return scenario
+
+    def snapshot(self):
+        now = time.time()
+        scenarios = [scenario.snapshot(now) for scenario in self.scenarios]
+        running = [scenario for scenario in scenarios
+                   if scenario["status"] == "running"]
+        completed = sum(s["completed"] for s in scenarios)
+        total = (sum(s["total"] for s in scenarios)
+                 if all(s["total"] for s in scenarios) else None)
+        rate = running[0]["iterations_per_second"] if running else None
+
+        # Scenarios run one after another at roughly the current rate
+        eta = None
+        if total is not None and rate:
+            eta = max(0, total - completed) / rate
+        return {"completed": completed,
+                "total": total,
+                "errors": sum(s["errors"] for s in scenarios),
+                "iterations_per_second": rate,
+                "eta": eta,
+                "scenarios": scenarios}
+
+
+class VerificationIndex(object):
+    """Pass/fail/skip history of tempest tests over verifications.
+
+    Results of a verification are read from the DB only once, either
+    when it finishes or when it is first met in the verification list.
+    Per-deployment test stats are updated incrementally.
+    """
+
+    STATUSES = {"success": "pass", "ok": "pass",
+                "fail": "fail", "failure": "fail", "error": "fail",
+                "skip": "skip"}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.verifications = {}
+        self.without_results = set()
+        self.deployments = collections.defaultdict(dict)
+
+    def clear(self):
+        with self.lock:
+            self.verifications.clear()
+            self.without_results.clear()
+            self.deployments.clear()
+
+    def add(self, verification):
+        """Index results of a finished verification."""
+        try:
+            results = db.verification_result_get(
+                verification["uuid"])["data"]
+        except exceptions.NotFoundException:
+            if verification["status"] in TASK_FINAL_STATUSES:
+                with self.lock:
+                    self.without_results.add(verification["uuid"])
+            return None
+
+        tests = {}
+        for test_id, test in results.get("tests", {}).items():
+            status = str(test.get("status", "")).lower()
+            tests[test_id] = (self.STATUSES.get(status, status),
+                              float(test.get("time") or 0))
+        entry = {"deployment_uuid": verification["deployment_uuid"],
+                 "created_at": verification["created_at"],
+                 "tests": tests}
+
+        with self.lock:
+            if verification["uuid"] in self.verifications:
+                return self.verifications[verification["uuid"]]
+            self.verifications[verification["uuid"]] = entry
+            stats = self.deployments[verification["deployment_uuid"]]
+            for test_id, (status, duration) in tests.items():
+                test = stats.setdefault(
+                    test_id, {"runs": 0, "pass": 0, "fail": 0, "skip": 0,
+                              "flips": 0, "outcomes": [],
+                              "timed_runs": 0, "time": 0.0})
+                test["runs"] += 1
+                test[status] = test.get(status, 0) + 1
+                if status in ("pass", "fail"):
+                    self.add_outcome(test, entry["created_at"], status)
+                if status == "pass" and duration:
+                    test["timed_runs"] += 1
+                    test["time"] += duration
+        return entry
+
+    @staticmethod
+    def add_outcome(test, created_at, status):
+        """Insert a pass/fail outcome in creation order, counting flips.
+
+        Verifications may be indexed in any order, e.g. an old one asked
+        for by diff before the list is indexed, so the outcome is put
+        between its neighbours and only their transitions are recounted.
+        """
+        outcomes = test["outcomes"]
+        i = bisect.bisect(outcomes, (created_at, status))
+        before = outcomes[i - 1][1] if i else None
+        after = outcomes[i][1] if i < len(outcomes) else None
+        if before is not None and after is not None and before != after:
+            test["flips"] -= 1
+        if before is not None and before != status:
+            test["flips"] += 1
+        if after is not None and after != status:
+            test["flips"] += 1
+        outcomes.insert(i, (created_at, status))
+
+    def stats(self, deployment_uuid, selected):
+        with self.lock:
+            stats = []
+            for test_id, test in self.deployments.get(deployment_uuid,
+                                                       {}).items():
+                if not selected(test):
+                    continue
+                test = dict(test, test=test_id)
+                outcomes = test.pop("outcomes")
+                test["last"] = outcomes[-1][1] if outcomes else None
+                stats.append(test)
+        return stats
+
+    def refresh(self):
+        """Index finished verifications which are not indexed yet."""
+        for verification in sorted(db.verification_list(),
+                                   key=lambda v: v["created_at"]):
+            if (verification["status"] in TASK_FINAL_STATUSES and
+                    verification["uuid"] not in self.verifications and
+                    verification["uuid"] not in self.without_results):
+                self.add(verification)
+
+    def get(self, verification_uuid):
+        """Return indexed results of a verification, None if unknown."""
+        entry = self.verifications.get(verification_uuid)
+        if entry is None:
+            try:
+                verification = db.verification_get(verification_uuid)
+            except exceptions.NotFoundException:
+                return None
+            entry = self.add(verification)
+        return entry
+
+    def diff(self, verification_uuid, other_uuid):
+        """Compare test statuses of two verifications."""
+        tests = self.get(verification_uuid)["tests"]
+        other_tests = self.get(other_uuid)["tests"]
+
+        changed = []
+        for test_id in sorted(set(tests) & set(other_tests)):
+            status, other_status = tests[test_id][0], other_tests[test_id][0]
+            if status != other_status:
+                changed.append({"test": test_id,
+                                "from": status,
+                                "to": other_status})
+        return {
+            "from": verification_uuid,
+            "to": other_uuid,
+            "new_failures": [c["test"] for c in changed
+                             if c["from"] == "pass" and c["to"] == "fail"],
+            "fixed": [c["test"] for c in changed
+                      if c["from"] == "fail" and c["to"] == "pass"],
+            "changed": changed,
+            "added": sorted(set(other_tests) - set(tests)),
+            "removed": sorted(set(tests) - set(other_tests))}
+
+    def flaky(self, deployment_uuid, limit):
+        """Return tests which switch between pass and fail most often."""
+        stats = self.stats(deployment_uuid, lambda test: test["flips"])
+        for test in stats:
+            test["flip_rate"] = (test["flips"] /
+                                 float(test["pass"] + test["fail"] - 1))
+        return heapq.nlargest(limit, stats,
+                              key=lambda test: (test["flip_rate"],
+                                                test["flips"]))
+
+    def slowest(self, deployment_uuid, limit):
+        """Return tests with the highest average time of passed runs."""
+        stats = self.stats(deployment_uuid,
+                           lambda test: test["timed_runs"])
+        for test in stats:
+            test["avg_time"] = test["time"] / test["timed_runs"]
+        return heapq.nlargest(limit, stats,
+                              key=lambda test: test["avg_time"])
+
+
+class AdmissionError(Exception):
+    def __init__(self, code, msg):
+        super(AdmissionError, self).__init__(msg)
+        self.code = code
+        self.msg = msg
+
+
+class Job(object):
+    def __init__(self, kind, deployment_uuid=None, client=None):
+        self.kind = kind
+        self.uuid = None
+        self.deployment_uuid = deployment_uuid
+        self.client = client
+        self.status = "admitted"
+        self.created_at = time.time()
+        self.pids = []
+
+
+class JobRegistry(object):
+    """Runs tasks, verifications and tempest installations in threads.
+
+    A job is first admitted against the [rallyd] limits, then started.
+    Started jobs wait in the queue for one of max_running_jobs slots.
+    Jobs are tracked until they finish, so the node can report how busy
+    it is. Aborted jobs give their slot back before their thread ends.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.jobs = set()
+        self.running = 0
+        self.local = threading.local()
+
+    def admit(self, kind, deployment_uuid=None, client=None):
+        """Register a job or raise AdmissionError if it doesn't fit."""
+        LOADER.load()
+        limits = CONF.rallyd
+        if node_load()["memory_headroom"] < limits.min_memory_headroom:
+            raise AdmissionError(503, "Node is running out of memory")
+
+        with self.condition:
+            active = [job for job in self.jobs if job.status != "aborting"]
+            waiting = len(active) - self.running
+            if (self.running >= limits.max_running_jobs and
+                    waiting >= limits.max_queued_jobs):
+                raise AdmissionError(
+                    503, "Node is saturated: {0} jobs running, {1} "
+                         "queued".format(self.running, waiting))
+            if limits.max_jobs_per_deployment and deployment_uuid and (
+                    sum(1 for job in active
+                        if job.deployment_uuid == deployment_uuid) >=
+                    limits.max_jobs_per_deployment):
+                raise AdmissionError(
+                    429, "Too many jobs for deployment "
+                         "{0}".format(deployment_uuid))
+            if limits.max_jobs_per_client and client and (
+                    sum(1 for job in active if job.client == client) >=
+                    limits.max_jobs_per_client):
+                raise AdmissionError(
+                    429, "Too many jobs for client {0}".format(client))
+
+            job = Job(kind, deployment_uuid, client)
+            self.jobs.add(job)
+        return job
+
+    @contextlib.contextmanager
+    def admission(self, kind, deployment_uuid=None, client=None):
+        """Admit a job, dropping it if the block doesn't start it."""
+        job = self.admit(kind, deployment_uuid, client)
+        try:
+            yield job
+        finally:
+            if job.status == "admitted":
+                self.finish(job)
+
+    def start(self, job, job_uuid, target, args):
+        job.uuid = job_uuid
+        job.status = "queued"
+        threading.Thread(target=self.run, args=(job, target, args),
+                         name="{0}-{1}".format(job.kind, job_uuid)).start()
+        return job
+
+    def run(self, job, target, args):
+        with self.condition:
+            while (job.status == "queued" and
+                   self.running >= CONF.rallyd.max_running_jobs):
+                self.condition.wait()
+            if job.status != "queued":
+                self.finish(job)
+                return
+            self.running += 1
+            job.status = "running"
+        self.local.job = job
+        try:
+            target(*args)
+        except Exception:
+            LOG.exception("%s %s failed", job.kind, job.uuid)
+        finally:
+            self.local.job = None
+            self.finish(job)
+
+    def current(self):
+        """Return the job run by the calling thread, if any."""
+        return getattr(self.local, "job", None)
+
+    def finish(self, job):
+        with self.condition:
+            if job.status == "running":
+                self.running -= 1
+            job.status = "done"
+            self.jobs.discard(job)
+            self.condition.notify_all()
+
+    def find(self, kind, job_uuid):
+        with self.condition:
+            for job in self.jobs:
+                if job.kind == kind and job.uuid == job_uuid:
+                    return job
+        return None
+
+    def cancel(self, job):
+        """Drop a job waiting for a slot, False if it is already running."""
+        with self.condition:
+            if job.status != "queued":
+                return False
+            job.status = "cancelled"
+            self.condition.notify_all()
+            return True
+
+    def release(self, job):
+        """Give the slot of an aborted job to the next queued one."""
+        with self.condition:
+            if job.status == "running":
+                self.running -= 1
+                job.status = "aborting"
+                self.condition.notify_all()
+
+    def counts(self):
+        counts = collections.Counter({"running": 0, "queued": 0})
+        with self.condition:
+            for job in self.jobs:
+                counts[job.kind] += 1
+                counts[job.status] += 1
+        return counts
+
+
+class CpuMeter(object):
+    """Share of its CPU quota the container used lately.
+
+    Host load average says nothing about a container throttled by a
+    quota, so the cgroup CPU time is sampled instead, at most once per
+    MIN_INTERVAL seconds.
+    """
+
+    MIN_INTERVAL = 1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sample = None
+        self.busy = None
+
+    def measure(self, cpus):
+        cpu_time = cgroup_cpu_time()
+        if cpu_time is None:
+            return None
+        now = time.time()
+        with self.lock:
+            if self.sample is None:
+                self.sample = now, cpu_time
+            elif now - self.sample[0] >= self.MIN_INTERVAL:
+                sampled_at, sampled_cpu_time = self.sample
+                self.busy = ((cpu_time - sampled_cpu_time) /
+                             (now - sampled_at) / cpus)
+                self.sample = now, cpu_time
+            return self.busy
+
+
+class TrackedPopen(subprocess.Popen):
+    """subprocess.Popen which records the processes each job starts.
+
+    An aborted job may not start any more processes, e.g. testr after
+    an abort which came while tempest was still being configured.
+    """
+
+    def __init__(self, *args, **kwargs):
+        job = JOBS.current()
+        if job is None:
+            super(TrackedPopen, self).__init__(*args, **kwargs)
+            return
+        # Aborts mark the job under the same lock before they look for
+        # its processes, so every process is either refused or found
+        with JOBS.condition:
+            if job.status == "aborting":
+                raise OSError(errno.EINTR, "{0} {1} is aborted".format(
+                    job.kind, job.uuid))
+            super(TrackedPopen, self).__init__(*args, **kwargs)
+            job.pids.append(self.pid)
+
+
+class AgentCheckHandler(SocketServer.BaseRequestHandler):
+    """Answers HAProxy agent checks with the node state and weight."""
+
+    def handle(self):
+        self.request.sendall("{0}\n".format(agent_status()))
 
 
 CONF = cfg.CONF
-CONF(sys.argv[1:], project="rally")
+CONF.register_opts([
+    cfg.IntOpt("max_running_jobs", default=10,
+               help="Number of tasks, verifications and tempest "
+                    "installations the node runs at once"),
+    cfg.IntOpt("max_queued_jobs", default=20,
+               help="Number of jobs waiting for a free slot, new jobs "
+                    "are rejected with 503 above it"),
+    cfg.IntOpt("max_jobs_per_deployment", default=0,
+               help="Number of running and queued jobs per deployment, "
+                    "new jobs are rejected with 429 above it, 0 means "
+                    "no limit"),
+    cfg.IntOpt("max_jobs_per_client", default=0,
+               help="Number of running and queued jobs per client "
+                    "address, new jobs are rejected with 429 above it, "
+                    "0 means no limit"),
+    cfg.ListOpt("trusted_proxies", default=[],
+                help="Addresses of proxies whose X-Forwarded-For header "
+                     "identifies clients, empty means any peer"),
+    cfg.FloatOpt("min_memory_headroom", default=0.05,
+                 help="Share of available memory below which new jobs "
+                      "are rejected with 503"),
+    cfg.IntOpt("retry_after", default=30,
+               help="Seconds clients are asked to wait before retrying "
+                    "a rejected job"),
+    cfg.StrOpt("database_connection",
+               help="SQLAlchemy URL of a server database (PostgreSQL, "
+                    "MySQL) overriding [database] connection"),
+    cfg.BoolOpt("sqlite_wal", default=True,
+                help="Use write-ahead logging for SQLite, so readers "
+                     "don't block task runners writing results"),
+    cfg.IntOpt("sqlite_busy_timeout", default=30000,
+               help="Milliseconds SQLite waits for a lock before failing "
+                    "with 'database is locked'"),
+    cfg.IntOpt("cache_size", default=1000,
+               help="Number of finished resources cached per process"),
+    cfg.IntOpt("cache_ttl", default=3600,
+               help="Seconds finished resources stay cached"),
+    cfg.IntOpt("idempotency_keys", default=10000,
+               help="Number of recent Idempotency-Key responses kept "
+                    "per process"),
+    cfg.IntOpt("idempotency_ttl", default=86400,
+               help="Seconds an Idempotency-Key response is kept"),
+    cfg.IntOpt("idempotency_lock_ttl", default=60,
+               help="Seconds a node holds an Idempotency-Key in the "
+                    "shared cache while it runs the request"),
+    cfg.ListOpt("cache_servers", default=[],
+                help="Memcached servers (host:port) to share cached "
+                     "resources and Idempotency-Key responses between "
+                     "rallyd nodes instead of keeping them per process"),
+], group="rallyd")
 WORKDIR = '/tmp'
+LAZY_LOAD = os.environ.get("RALLYD_LAZY_LOAD", "").lower() in ("1", "true")
+AGENT_PORT = int(os.environ.get("RALLYD_AGENT_PORT", 8001))
+CGROUP_ROOT = "/sys/fs/cgroup"
+# consts.TaskStatus values, spelled out to keep Rally imports lazy
+TASK_FINAL_STATUSES = ("finished", "failed", "aborted")
+CLASS_FIXTURE_RE = re.compile(r"^(?:setUpClass|tearDownClass) \((.+)\)$")
+SERVING_AT = None
+STAT_FIELDS = ("min", "median", "p90", "p95", "max", "avg")
+TASK_AGGREGATES = LRUCache(maxsize=4096)
+TASK_PROGRESS = LRUCache(maxsize=1000)
+VERIFICATION_INDEX = VerificationIndex()
+JOBS = JobRegistry()
+CPU_METER = CpuMeter()
+RESPONSES = ResponseCache("responses")
+SUBMISSIONS = ResponseCache("submissions", "idempotency_keys",
+                            "idempotency_ttl")
+SUBMISSIONS_IN_FLIGHT = {}
+SUBMISSION_POLL_INTERVAL = 0.5
+SUBMISSIONS_LOCK = threading.Lock()
+STDOUT = ThreadLocalStdout(sys.stdout)
 app = Rallyd(__name__)
 app.json_encoder = DateJSONEncoder
 
@@ -71,6 +910,487 @@ def setup_logging(log_filename_prefix, log_filename_suffix=''):
     logger.setLevel(logging.DEBUG)
     logger.addHandler(file_handler)
 
+
+def tune_sqlite(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA busy_timeout = {0:d}".format(
+        CONF.rallyd.sqlite_busy_timeout))
+    if CONF.rallyd.sqlite_wal:
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.close()
+
+
+def install_progress_hooks():
+    """Count iterations of every scenario runner for task progress.
+
+    Rally hands each finished iteration to ScenarioRunner._send_result
+    in the thread running the task, so counting there is cheap.
+    """
+    runner = importlib.import_module("rally.task.runner")
+    run = runner.ScenarioRunner.run
+    send_result = runner.ScenarioRunner._send_result
+
+    @functools.wraps(run)
+    def counted_run(self, name, *args, **kwargs):
+        task_uuid = self.task["uuid"]
+        progress = TASK_PROGRESS.get(task_uuid)
+        if progress is None:
+            progress = TaskProgress({})
+            TASK_PROGRESS.set(task_uuid, progress)
+        self.rallyd_progress = progress.start(name, self.config)
+        try:
+            return run(self, name, *args, **kwargs)
+        finally:
+            self.rallyd_progress.finish()
+
+    @functools.wraps(send_result)
+    def counted_send_result(self, result):
+        send_result(self, result)
+        progress = getattr(self, "rallyd_progress", None)
+        if progress is not None:
+            progress.add(result)
+
+    runner.ScenarioRunner.run = counted_run
+    runner.ScenarioRunner._send_result = counted_send_result
+
+
+def configure_database():
+    """Set up Rally DB access for concurrent runners and API threads.
+
+    Called by the loader right after the config is parsed, before Rally
+    creates its engine.
+    """
+    import sqlalchemy
+
+    if CONF.rallyd.database_connection:
+        CONF.set_override("connection", CONF.rallyd.database_connection,
+                          group="database")
+
+    # Server databases get a pool big enough for every running job and a
+    # few API threads; values from rally.conf still take precedence.
+    for name, value in (("max_pool_size", CONF.rallyd.max_running_jobs + 5),
+                        ("max_overflow", CONF.rallyd.max_running_jobs)):
+        try:
+            CONF.set_default(name, value, group="database")
+        except (cfg.NoSuchOptError, cfg.NoSuchGroupError):
+            pass
+
+    sqlalchemy.event.listen(sqlalchemy.engine.Engine, "connect", tune_sqlite)
+
+
+def runner_processes(job_pids):
+    """Return pids of test runners started by the given job processes.
+
+    Only testr and its subunit workers are picked, so the rest of the
+    pipeline still gets to store the results of finished tests.
+    """
+    children = collections.defaultdict(list)
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(pid)) as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        children[ppid].append(int(pid))
+
+    # Pids of finished job processes may be reused by strangers already
+    pids = []
+    descendants = [pid for pid in children[os.getpid()] if pid in job_pids]
+    while descendants:
+        pid = descendants.pop()
+        descendants.extend(children[pid])
+        try:
+            with open("/proc/{0}/cmdline".format(pid)) as f:
+                argv = f.read().split("\0")
+        except IOError:
+            continue
+        # The shell running the pipeline has to wait for it, not die
+        if os.path.basename(argv[0]) in ("sh", "bash"):
+            continue
+        cmdline = " ".join(argv)
+        if "testr" in cmdline or "subunit.run" in cmdline:
+            pids.append(pid)
+    return pids
+
+
+def render_to_file(path, func, *args, **kwargs):
+    """Atomically write everything func prints into path."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix=".{0}.".format(
+                                        os.path.basename(path)))
+    try:
+        with os.fdopen(fd, "w") as output:
+            with STDOUT.redirect(output):
+                func(*args, **kwargs)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def read_cgroup(*names):
+    """Return the content of the first readable cgroup file, if any."""
+    for name in names:
+        try:
+            with open(os.path.join(CGROUP_ROOT, name)) as f:
+                return f.read().strip()
+        except IOError:
+            continue
+    return None
+
+
+def cgroup_memory():
+    """Return memory limit and usage of the container in MB.
+
+    Usage leaves out inactive page cache, which the kernel reclaims
+    before hitting the limit, as docker stats does. None if the files
+    are missing or there is no limit (cgroup v1 reports a huge one).
+    """
+    limit = read_cgroup("memory.max", "memory/memory.limit_in_bytes")
+    usage = read_cgroup("memory.current", "memory/memory.usage_in_bytes")
+    if limit in (None, "max") or usage is None:
+        return None
+    stat = dict(line.split()
+                for line in (read_cgroup("memory.stat",
+                                         "memory/memory.stat") or
+                             "").splitlines())
+    inactive = int(stat.get("inactive_file",
+                            stat.get("total_inactive_file", 0)))
+    return (int(limit) / 1048576.0,
+            max(0, int(usage) - inactive) / 1048576.0)
+
+
+def cgroup_cpus():
+    """Return the CPU quota of the container in CPUs, None if unlimited."""
+    cpu_max = read_cgroup("cpu.max")
+    if cpu_max is not None:
+        quota, period = cpu_max.split()
+    else:
+        quota = read_cgroup("cpu/cpu.cfs_quota_us")
+        period = read_cgroup("cpu/cpu.cfs_period_us")
+    if quota in (None, "max") or period is None or int(quota) <= 0:
+        return None
+    return float(quota) / int(period)
+
+
+def cgroup_cpu_time():
+    """Return CPU seconds the container has used so far, if known."""
+    for line in (read_cgroup("cpu.stat") or "").splitlines():
+        name, value = line.split()
+        if name == "usage_usec":
+            return int(value) / 1e6
+    usage = read_cgroup("cpuacct/cpuacct.usage")
+    if usage is not None:
+        return int(usage) / 1e9
+    return None
+
+
+def node_load():
+    """Return CPU and memory usage of the node.
+
+    In a container with memory or CPU limits, usage is measured against
+    the limits rather than the host.
+    """
+    meminfo = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            meminfo[name] = int(value.split()[0]) / 1024.0
+    memory_total = meminfo["MemTotal"]
+    memory_available = meminfo.get(
+        "MemAvailable",
+        meminfo["MemFree"] + meminfo["Buffers"] + meminfo["Cached"])
+    memory = cgroup_memory()
+    if memory is not None and memory[0] < memory_total:
+        memory_total, memory_used = memory
+        memory_available = min(memory_available,
+                               max(0.0, memory_total - memory_used))
+
+    cpus = multiprocessing.cpu_count()
+    load_average = os.getloadavg()[0]
+    cpu_busy = load_average / cpus
+    quota = cgroup_cpus()
+    if quota is not None and quota < cpus:
+        cpus = quota
+        cpu_busy = CPU_METER.measure(cpus)
+        if cpu_busy is None:
+            cpu_busy = load_average / cpus
+    return {"cpus": cpus,
+            "load_average": load_average,
+            "cpu_headroom": max(0.0, 1 - cpu_busy),
+            "memory_total_mb": memory_total,
+            "memory_available_mb": memory_available,
+            "memory_headroom": memory_available / memory_total}
+
+
+def node_weight(load, running_jobs):
+    """Weight in percent by the scarcest of job slots, CPU and memory.
+
+    A ready node keeps at least 1%, since HAProxy sends it status reads
+    and aborts of its own jobs too; admission control rejects the jobs
+    a saturated node can't take.
+    """
+    if LOADER.status != "ready":
+        return 0
+    job_headroom = max(
+        0.0, 1 - running_jobs / float(CONF.rallyd.max_running_jobs))
+    return max(1, int(100 * min(job_headroom,
+                                load["cpu_headroom"],
+                                load["memory_headroom"])))
+
+
+def agent_status():
+    if LOADER.status == "failed":
+        return "down"
+    if LOADER.status != "ready":
+        return "drain"
+    weight = node_weight(node_load(), JOBS.counts()["running"])
+    return "up ready {0}%".format(weight)
+
+
+def start_agent_check(port):
+    SocketServer.ThreadingTCPServer.allow_reuse_address = True
+    server = SocketServer.ThreadingTCPServer(("0.0.0.0", port),
+                                             AgentCheckHandler)
+    server.daemon_threads = True
+    agent = threading.Thread(target=server.serve_forever, name="agent-check")
+    agent.daemon = True
+    agent.start()
+
+
+def client_id():
+    """Address of the client, as seen by HAProxy if it is in front.
+
+    Clients may send X-Forwarded-For themselves, so only the last entry,
+    appended by the proxy rallyd is talking to, can be trusted.
+    """
+    LOADER.load()
+    forwarded_for = flask.request.headers.get("X-Forwarded-For")
+    trusted_proxies = CONF.rallyd.trusted_proxies
+    if forwarded_for and (not trusted_proxies or
+                          flask.request.remote_addr in trusted_proxies):
+        return forwarded_for.split(",")[-1].strip()
+    return flask.request.remote_addr
+
+
+def cached_json(key, load):
+    """Respond with a JSON body from the cache or from load().
+
+    load returns the payload and whether it is final, i.e. may be cached.
+    Responses carry an ETag and turn into 304 on a matching
+    If-None-Match.
+    """
+    cached = RESPONSES.get(key)
+    if cached is None:
+        payload, final = load()
+        body = flask.json.dumps(payload)
+        cached = hashlib.md5(body).hexdigest(), body
+        if final:
+            RESPONSES.set(key, cached)
+
+    etag, body = cached
+    response = flask.Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response.make_conditional(flask.request)
+
+
+def idempotent(view):
+    """Make a job submission view honour the Idempotency-Key header.
+
+    The first request with a key runs the view, concurrent ones with the
+    same key wait for it. A successful response is kept and replayed for
+    the key; a failed one lets a waiting or later request try again.
+
+    Requests are deduplicated across rallyd nodes only when [rallyd]
+    cache_servers is set: the key is then reserved in memcached before
+    the view runs. Otherwise each node knows only its own requests.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = flask.request.headers.get("Idempotency-Key")
+        if not key:
+            return view(*args, **kwargs)
+        key = u"{0} {1}".format(flask.request.path, key).encode("utf-8")
+        key = "idempotency:" + hashlib.md5(key).hexdigest()
+        fingerprint = hashlib.md5(flask.request.data).hexdigest()
+
+        while True:
+            owner = False
+            with SUBMISSIONS_LOCK:
+                stored = SUBMISSIONS.get(key)
+                event = SUBMISSIONS_IN_FLIGHT.get(key)
+                if stored is None and event is None:
+                    event = SUBMISSIONS_IN_FLIGHT[key] = threading.Event()
+                    owner = True
+            if stored is not None:
+                stored_fingerprint, status, data, mimetype = stored
+                if stored_fingerprint != fingerprint:
+                    return flask.jsonify(
+                        {"msg": "Idempotency-Key was used for "
+                                "another request"}), 422
+                return flask.Response(data, status, mimetype=mimetype,
+                                      headers={"Idempotent-Replayed":
+                                               "true"})
+            if not owner:
+                event.wait()
+            elif SUBMISSIONS.reserve(key, CONF.rallyd.idempotency_lock_ttl):
+                break
+            else:
+                # Another node runs the request, poll for its response
+                finish_submission(key, event)
+                time.sleep(SUBMISSION_POLL_INTERVAL)
+
+        try:
+            response = flask.make_response(view(*args, **kwargs))
+            if response.status_code < 300:
+                SUBMISSIONS.set(key, (fingerprint, response.status_code,
+                                      response.data, response.mimetype))
+            return response
+        finally:
+            SUBMISSIONS.unreserve(key)
+            finish_submission(key, event)
+    return wrapper
+
+
+def finish_submission(key, event):
+    with SUBMISSIONS_LOCK:
+        del SUBMISSIONS_IN_FLIGHT[key]
+    event.set()
+
+
+def paginate(model):
+    """List rows of a Rally DB model by the offset and limit arguments.
+
+    The page is cut by the query itself, so fetching a big history page
+    by page doesn't read the whole table for every page.
+    """
+    offset = int(flask.request.args.get('offset', 0))
+    limit = flask.request.args.get('limit', None)
+    query = db.get_impl().model_query(model).order_by(model.id)
+    if limit is not None:
+        query = query.limit(int(limit))
+    return query.offset(offset).all()
+
+
+def nan_to_none(values):
+    return [None if np.isnan(value) else float(value) for value in values]
+
+
+def load_task_columns(task_uuid):
+    """Return iteration data of every task scenario as NumPy columns.
+
+    Durations are a matrix with a row per iteration (ordered by
+    timestamp) and a column per action, the first column being the whole
+    iteration. Failed iterations and missing atomic actions are NaN.
+    """
+    scenarios = []
+    for result in db.task_get_detailed(task_uuid)["results"]:
+        raw = sorted(result["data"]["raw"], key=lambda itr: itr["timestamp"])
+        actions = sorted(set(name for itr in raw
+                             for name in itr.get("atomic_actions") or {}))
+        durations = np.array(
+            [[itr["duration"]] +
+             [(itr.get("atomic_actions") or {}).get(name) for name in actions]
+             for itr in raw], dtype=float).reshape(len(raw), len(actions) + 1)
+        success = np.array([not itr["error"] for itr in raw], dtype=bool)
+        durations[~success] = np.nan
+
+        scenarios.append({
+            "name": result["key"]["name"],
+            "pos": result["key"]["pos"],
+            "actions": ["total"] + actions,
+            "durations": durations,
+            "success": success,
+            "timestamps": np.array([itr["timestamp"] for itr in raw],
+                                   dtype=float),
+            "load_duration": result["data"].get("load_duration"),
+            "full_duration": result["data"].get("full_duration")})
+    return scenarios
+
+
+def aggregate_durations(durations):
+    """Compute STAT_FIELDS for every column of a durations matrix.
+
+    Returns an array with a row per column; NaN marks stats of columns
+    without a single measured value.
+    """
+    stats = np.empty((durations.shape[1], len(STAT_FIELDS)))
+    stats.fill(np.nan)
+    filled = (~np.isnan(durations)).any(axis=0)
+    if filled.any():
+        values = durations[:, filled]
+        stats[filled] = np.vstack([
+            np.nanmin(values, axis=0),
+            np.nanpercentile(values, [50, 90, 95], axis=0),
+            np.nanmax(values, axis=0),
+            np.nanmean(values, axis=0)]).T
+    return stats
+
+
+def downsample(timestamps, durations, points):
+    """Average consecutive iterations into at most `points` buckets."""
+    if not len(timestamps):
+        return timestamps, durations
+    starts = np.linspace(0, len(timestamps), min(points, len(timestamps)),
+                         endpoint=False).astype(int)
+    sizes = np.diff(np.append(starts, len(timestamps)))
+    measured = ~np.isnan(durations)
+    sums = np.add.reduceat(np.where(measured, durations, 0), starts, axis=0)
+    counts = np.add.reduceat(measured.astype(int), starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    return np.add.reduceat(timestamps, starts) / sizes, means
+
+
+def get_task_aggregate(task_uuid):
+    """Return duration stats of a task in columnar form.
+
+    Labels are (scenario name, position, action) tuples, one per row of
+    the stats matrix. Aggregates of finished tasks are cached.
+    """
+    aggregate = TASK_AGGREGATES.get(task_uuid)
+    if aggregate is not None:
+        return aggregate
+
+    status = db.task_get(task_uuid)["status"]
+    labels, blocks = [], [np.empty((0, len(STAT_FIELDS)))]
+    for scenario in load_task_columns(task_uuid):
+        labels.extend((scenario["name"], scenario["pos"], action)
+                      for action in scenario["actions"])
+        blocks.append(aggregate_durations(scenario["durations"]))
+    aggregate = TaskAggregate(labels, np.vstack(blocks))
+
+    if status in TASK_FINAL_STATUSES:
+        TASK_AGGREGATES.set(task_uuid, aggregate)
+    return aggregate
+
+
+def stack_task_aggregates(task_uuids):
+    """Align aggregates of tasks into a (tasks, labels, stats) array."""
+    aggregates = [get_task_aggregate(task_uuid) for task_uuid in task_uuids]
+    labels = sorted(set(label for aggregate in aggregates
+                        for label in aggregate.labels))
+    index = dict((label, i) for i, label in enumerate(labels))
+
+    stacked = np.empty((len(aggregates), len(labels), len(STAT_FIELDS)))
+    stacked.fill(np.nan)
+    for i, aggregate in enumerate(aggregates):
+        stacked[i, [index[label] for label in aggregate.labels]] = \
+            aggregate.stats
+    return labels, stacked
+
+
+@app.errorhandler(AdmissionError)
+def reject_job(error):
+    return (flask.jsonify({"msg": error.msg}), error.code,
+            {"Retry-After": str(CONF.rallyd.retry_after)})
+
+
 @app.route("/api_map", methods=['GET'])
 def api_map():
     output = []
@@ -93,9 +1413,45 @@ def api_map():
     return flask.jsonify({"map": output})
 
 
+@app.route("/ready", methods=['GET'])
+def get_readiness():
+    return (flask.jsonify({"status": LOADER.status}),
+            200 if LOADER.status == "ready" else 503)
+
+
+@app.route("/health", methods=['GET'])
+def get_health():
+    load = node_load()
+    jobs = JOBS.counts()
+    return (flask.jsonify(
+        {"health": {"status": LOADER.status,
+                    "jobs": jobs,
+                    "load": load,
+                    "weight": node_weight(load, jobs["running"])}}),
+            200 if LOADER.status == "ready" else 503)
+
+
+@app.route("/startup", methods=['GET'])
+def get_startup_report():
+    return flask.jsonify(
+        {"startup": {"mode": "lazy" if LAZY_LOAD else "eager",
+                     "status": LOADER.status,
+                     "serving_after": (SERVING_AT - STARTED_AT
+                                       if SERVING_AT else None),
+                     "load": LOADER.timings,
+                     "load_total": sum(LOADER.timings.values())}})
+
+
 @app.route("/db", methods=['POST'])
 def recreate_db():
-    subprocess.call("rally-manage db recreate".split())
+    # In-process, so that [rallyd] database_connection is honoured
+    db.db_drop()
+    db.db_create()
+    # Like rally-manage, forget the default deployment which is gone now
+    envutils.clear_env()
+    TASK_AGGREGATES.clear()
+    VERIFICATION_INDEX.clear()
+    RESPONSES.clear()
     return flask.jsonify({"msg": "Db recreated"}), 201
 
 
@@ -126,14 +1482,18 @@ def list_deployments():
 
 @app.route("/deployments/<deployment_uuid>", methods=['GET'])
 def get_deployment(deployment_uuid):
-    deployment = api.Deployment.get(deployment_uuid)
-    return flask.jsonify(
-        {"deployment": deployment.deployment._as_dict()})
+    def load():
+        deployment = api.Deployment.get(deployment_uuid).deployment
+        return ({"deployment": deployment._as_dict()},
+                deployment["status"] == consts.DeployStatus.DEPLOY_FINISHED)
+
+    return cached_json("deployment:{0}".format(deployment_uuid), load)
 
 
 @app.route("/deployments/<deployment_uuid>", methods=['PUT'])
 def recreate_deployment(deployment_uuid):
     api.Deployment.recreate(deployment_uuid)
+    RESPONSES.delete("deployment:{0}".format(deployment_uuid))
     deployment = api.Deployment.get(deployment_uuid)
     return flask.jsonify(
         {"deployment": deployment.deployment._as_dict()}), 201
@@ -142,19 +1502,20 @@ def recreate_deployment(deployment_uuid):
 @app.route("/deployments/<deployment_uuid>", methods=['DELETE'])
 def delete_deployment(deployment_uuid):
     api.Deployment.destroy(deployment_uuid)
+    RESPONSES.delete("deployment:{0}".format(deployment_uuid))
     return flask.jsonify({"msg": "Deployment {0} deleted successfully"}), 204
 
 
 @app.route("/deployments/<deployment_uuid>/tempest", methods=['POST'])
+@idempotent
 def install_tempest(deployment_uuid):
     request = json.loads(flask.request.data)
     tempest_source = request.get('tempest_source', None)
 
-    setup_logging('tempest_installation', deployment_uuid)
-
-    threading.Thread(target=api.Verification.install_tempest,
-                     args=(deployment_uuid,
-                           tempest_source)).start()
+    with JOBS.admission("tempest", deployment_uuid, client_id()) as job:
+        setup_logging('tempest_installation', deployment_uuid)
+        JOBS.start(job, deployment_uuid, api.Verification.install_tempest,
+                   (deployment_uuid, tempest_source))
 
     return flask.jsonify(
         {"msg": "Start installing tempest for "
@@ -173,8 +1534,9 @@ def get_tempest_status(deployment_uuid):
 
 @app.route("/deployments/<deployment_uuid>/tempest", methods=['PUT'])
 def reinstall_tempest(deployment_uuid):
-    threading.Thread(target=api.Verification.reinstall_tempest,
-                     args=(deployment_uuid)).start()
+    with JOBS.admission("tempest", deployment_uuid, client_id()) as job:
+        JOBS.start(job, deployment_uuid, api.Verification.reinstall_tempest,
+                   (deployment_uuid,))
     return flask.jsonify(
         {"msg": "Tempest re-installation started for "
                 "deployment {0}".format(deployment_uuid),
@@ -190,6 +1552,7 @@ def uninstall_tempest(deployment_uuid):
 
 
 @app.route("/tasks", methods=['POST'])
+@idempotent
 def create_task():
     def byteify(input_struct):
         if isinstance(input_struct, dict):
@@ -217,25 +1580,117 @@ def create_task():
         task_config = api.Task.render_template(task_config, **task_params)
 
     task_config = json.loads(task_config)
-    task = api.Task.create(deployment_uuid, tag)
-    setup_logging('task', task.task.uuid)
-    threading.Thread(target=api.Task.start,
-                     args=(deployment_uuid,
-                           task_config,
-                           task,
-                           abort_on_sla_failure)).start()
+    with JOBS.admission("task", deployment_uuid, client_id()) as job:
+        task = api.Task.create(deployment_uuid, tag)
+        setup_logging('task', task.task.uuid)
+        TASK_PROGRESS.set(task.task.uuid, TaskProgress(task_config))
+        JOBS.start(job, task.task.uuid, api.Task.start,
+                   (deployment_uuid, task_config, task,
+                    abort_on_sla_failure))
 
     return flask.jsonify({"task": task.task._as_dict()}), 201
 
 
 @app.route("/tasks", methods=['GET'])
 def list_tasks():
-    return flask.jsonify({"tasks": [i._as_dict() for i in db.task_list()]})
+    return flask.jsonify(
+        {"tasks": [i._as_dict() for i in paginate(db_models.Task)]})
+
+
+@app.route("/tasks/compare", methods=['GET'])
+def compare_tasks():
+    task_uuids = [task_uuid
+                  for value in flask.request.args.getlist('uuids')
+                  for task_uuid in value.split(',') if task_uuid]
+    if len(task_uuids) < 2:
+        flask.abort(400)
+
+    labels, stacked = stack_task_aggregates(task_uuids)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        deltas = (stacked - stacked[0]) / stacked[0] * 100
+
+    scenarios = []
+    for i, (name, pos, action) in enumerate(labels):
+        scenarios.append({
+            "name": name,
+            "pos": pos,
+            "action": action,
+            "values": dict((field, nan_to_none(stacked[:, i, j]))
+                           for j, field in enumerate(STAT_FIELDS)),
+            "delta": dict((field, nan_to_none(deltas[:, i, j]))
+                          for j, field in enumerate(STAT_FIELDS))})
+
+    return flask.jsonify(
+        {"comparison": {"tasks": task_uuids,
+                        "baseline": task_uuids[0],
+                        "scenarios": scenarios}})
+
+
+@app.route("/tasks/trend", methods=['GET'])
+def get_task_trend():
+    tag = flask.request.args.get('tag', None)
+    stat = flask.request.args.get('stat', 'p95')
+    limit = int(flask.request.args.get('limit', 30))
+    if tag is None or stat not in STAT_FIELDS or limit < 2:
+        flask.abort(400)
+
+    tasks = sorted((task for task in db.task_list()
+                    if task["tag"] == tag and
+                    task["status"] == consts.TaskStatus.FINISHED),
+                   key=lambda task: task["created_at"])[-limit:]
+    if not tasks:
+        flask.abort(404)
+    labels, stacked = stack_task_aggregates(
+        [task["uuid"] for task in tasks])
+    values = stacked[:, :, STAT_FIELDS.index(stat)]
+
+    # Last run is compared with the median of the preceding ones
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        baseline = np.nanmedian(values[:-1], axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        deltas = (values[-1] - baseline) / baseline * 100
+
+    scenarios = []
+    for i, (name, pos, action) in enumerate(labels):
+        scenarios.append({
+            "name": name,
+            "pos": pos,
+            "action": action,
+            "values": nan_to_none(values[:, i]),
+            "baseline": nan_to_none(baseline[i:i + 1])[0],
+            "delta": nan_to_none(deltas[i:i + 1])[0]})
+    scenarios.sort(key=lambda scenario: (scenario["delta"] is None,
+                                         -(scenario["delta"] or 0)))
+
+    return flask.jsonify(
+        {"trend": {"tag": tag,
+                   "stat": stat,
+                   "tasks": [{"uuid": task["uuid"],
+                              "created_at": task["created_at"]}
+                             for task in tasks],
+                   "scenarios": scenarios}})
 
 
 @app.route("/tasks/<task_uuid>", methods=['GET'])
 def get_task(task_uuid):
-    return flask.jsonify({"task": db.task_get(task_uuid)._as_dict()})
+    def load():
+        task = db.task_get(task_uuid)
+        return ({"task": task._as_dict()},
+                task["status"] in TASK_FINAL_STATUSES)
+
+    return cached_json("task:{0}".format(task_uuid), load)
+
+
+@app.route("/tasks/<task_uuid>/progress", methods=['GET'])
+def get_task_progress(task_uuid):
+    progress = TASK_PROGRESS.get(task_uuid)
+    if progress is None:
+        flask.abort(404)
+
+    task_progress = progress.snapshot()
+    task_progress["task_id"] = task_uuid
+    return flask.jsonify({"task_progress": task_progress})
 
 
 @app.route("/tasks/<task_uuid>/log", methods=['GET'])
@@ -265,17 +1720,72 @@ def get_task_log(task_uuid):
 
 @app.route("/tasks/<task_uuid>/result", methods=['GET'])
 def get_task_result(task_uuid):
-    detailed_filename = ("task_{0}_detailed.log".format(task_uuid))
+    # Results of finished tasks never change, so they are rendered only
+    # once, under a name renders of a running task never get
+    task = db.task_get(task_uuid)
+    if task["status"] in TASK_FINAL_STATUSES:
+        detailed_filename = "task_{0}_detailed_final.log".format(task_uuid)
+    else:
+        detailed_filename = "task_{0}_detailed.log".format(task_uuid)
+    detailed_path = os.path.join(WORKDIR, detailed_filename)
 
-    tee = Tee(detailed_filename, "w")
-    with open(os.path.join(WORKDIR,
-                           detailed_filename), 'w') as detailed_file:
-        sys.stdout = detailed_file
-        task_cli.TaskCommands().detailed(task_uuid)
+    if (task["status"] not in TASK_FINAL_STATUSES or
+            not os.path.exists(detailed_path)):
+        render_to_file(detailed_path,
+                       task_cli.TaskCommands().detailed, task_uuid)
 
     return flask.send_from_directory(WORKDIR, detailed_filename)
 
 
+@app.route("/tasks/<task_uuid>/data", methods=['GET'])
+def get_task_data(task_uuid):
+    points = flask.request.args.get('points', None)
+    if points is not None:
+        points = int(points)
+        if points < 1:
+            flask.abort(400)
+
+    scenarios = []
+    for scenario in load_task_columns(task_uuid):
+        durations = scenario["durations"]
+        iterations = len(scenario["success"])
+        load_duration = scenario["load_duration"]
+
+        counts = (~np.isnan(durations)).sum(axis=0)
+        stats = aggregate_durations(durations)
+        actions = []
+        for name, count, values in zip(scenario["actions"], counts, stats):
+            action = dict(zip(STAT_FIELDS, nan_to_none(values)))
+            action.update({"name": name, "count": int(count)})
+            actions.append(action)
+
+        data = {
+            "name": scenario["name"],
+            "pos": scenario["pos"],
+            "iterations": iterations,
+            "success_rate": (float(scenario["success"].mean()) * 100
+                             if iterations else None),
+            "throughput": (iterations / load_duration
+                           if load_duration else None),
+            "load_duration": load_duration,
+            "full_duration": scenario["full_duration"],
+            "actions": actions}
+
+        if points is not None:
+            timestamps, means = downsample(scenario["timestamps"],
+                                           durations, points)
+            data["series"] = {
+                "timestamps": nan_to_none(timestamps),
+                "durations": dict(
+                    (name, nan_to_none(means[:, i]))
+                    for i, name in enumerate(scenario["actions"]))}
+        scenarios.append(data)
+
+    return flask.jsonify(
+        {"task_data": {"task_id": task_uuid,
+                       "scenarios": scenarios}})
+
+
 @app.route("/tasks/<task_uuid>/report", methods=['GET'])
 def get_task_report(task_uuid):
     report_format = flask.request.args.get('format', 'html')
@@ -290,23 +1800,140 @@ def get_task_report(task_uuid):
     return flask.send_from_directory(WORKDIR, task_report_filename)
 
 
+@app.route("/tasks/<task_uuid>/abort", methods=['POST'])
+def abort_task(task_uuid):
+    soft = flask.request.args.get('soft', False) and True
+
+    try:
+        task = db.task_get(task_uuid)
+    except exceptions.NotFoundException:
+        flask.abort(404)
+    if task["status"] in TASK_FINAL_STATUSES:
+        return flask.jsonify(
+            {"msg": "Task {0} is already {1}".format(task_uuid,
+                                                     task["status"])}), 409
+
+    job = JOBS.find("task", task_uuid)
+    if job is not None and JOBS.cancel(job):
+        db.task_update(task_uuid, {"status": consts.TaskStatus.ABORTED})
+    else:
+        # A hard abort only stops Rally from starting new iterations, the
+        # running ones still finish; a soft abort lets the current
+        # scenario run to its end
+        api.Task.abort(task_uuid, soft)
+        if job is not None:
+            JOBS.release(job)
+
+    return flask.jsonify(
+        {"msg": "Task {0} is {1}aborted".format(task_uuid,
+                                                "soft " if soft else "")}), 202
+
+
 @app.route("/tasks/<task_uuid>", methods=['DELETE'])
 def delete_task(task_uuid):
     force = flask.request.args.get('force', False)
     if force:
         force = True
     api.Task.delete(task_uuid, force)
+    TASK_AGGREGATES.delete(task_uuid)
+    TASK_PROGRESS.delete(task_uuid)
+    RESPONSES.delete("task:{0}".format(task_uuid))
     return flask.jsonify(
         {"msg": "Task {0} is deleted".format(task_uuid)}), 204
 
 
+def save_verification_params(verification_uuid, **params):
+    params_filename = "verification_{0}.json".format(verification_uuid)
+    with open(os.path.join(WORKDIR, params_filename), "w") as f:
+        json.dump(params, f)
+
+
+def load_verification_params(verification_uuid):
+    params_filename = "verification_{0}.json".format(verification_uuid)
+    try:
+        with open(os.path.join(WORKDIR, params_filename)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def tests_regex(test_ids):
+    """Build a testr filter matching exactly the given tests.
+
+    Tags like [id-...,smoke] are stripped since they may differ between
+    the listed test ids and the stored results. Class fixture failures,
+    reported as "setUpClass (<class path>)", select every test of the
+    class. The regex goes through the shell when tempest is run, hence
+    the quoting.
+    """
+    names, classes = set(), set()
+    for test_id in test_ids:
+        fixture = CLASS_FIXTURE_RE.match(test_id)
+        if fixture:
+            classes.add(fixture.group(1))
+        else:
+            names.add(test_id.split("[")[0])
+
+    patterns = []
+    if names:
+        patterns.append("^(?:{0})(?:\\[|$)".format(
+            "|".join(re.escape(name) for name in sorted(names))))
+    if classes:
+        patterns.append("^(?:{0})\\.".format(
+            "|".join(re.escape(name) for name in sorted(classes))))
+    return pipes.quote("|".join(patterns))
+
+
+def verify(verifier, verification_uuid, set_name, regex, concurrency):
+    tempest_log_filename = "tempest_{0}.log".format(verification_uuid)
+    with open(os.path.join(WORKDIR, tempest_log_filename), 'w') as log:
+        job = JOBS.current()
+        try:
+            if job is None or job.status != "aborting":
+                with STDOUT.redirect(log, tee=True):
+                    verifier.verify(set_name, regex, concurrency)
+        finally:
+            if job is not None and job.status == "aborting":
+                db.verification_update(verification_uuid,
+                                       {"status": consts.TaskStatus.ABORTED})
+                # Rally had already marked it finished, which may have
+                # been cached as final in the meantime
+                RESPONSES.delete(
+                    "verification:{0}".format(verification_uuid),
+                    "verification_result:{0}:0".format(verification_uuid),
+                    "verification_result:{0}:1".format(verification_uuid))
+            VERIFICATION_INDEX.add(db.verification_get(verification_uuid))
+
+
+def start_verification(deployment_uuid, set_name, regex, tempest_config,
+                       concurrency, rerun_of=None):
+    with JOBS.admission("verification", deployment_uuid,
+                        client_id()) as job:
+        verification = objects.Verification(deployment_uuid=deployment_uuid)
+        verifier = tempest.Tempest(deployment_uuid,
+                                   verification=verification,
+                                   tempest_config=tempest_config)
+
+        if not verifier.is_installed():
+            flask.abort(500)
+
+        save_verification_params(verification.uuid,
+                                 deployment_uuid=deployment_uuid,
+                                 set_name=set_name,
+                                 regex=regex,
+                                 tempest_config=tempest_config,
+                                 concurrency=concurrency,
+                                 rerun_of=rerun_of)
+
+        JOBS.start(job, verification.uuid, verify,
+                   (verifier, verification.uuid, set_name, regex,
+                    concurrency))
+    return verification
+
+
 @app.route("/verifications", methods=['POST'])
+@idempotent
 def run_verification():
-    def verify(verifier, verification_uuid, set_name, regex, concurrency):
-        tempest_log_filename = "tempest_{0}.log".format(verification_uuid)
-        tee = Tee(os.path.join(WORKDIR, tempest_log_filename), 'w')
-        verifier.verify(set_name, regex, concurrency)
-
     request = json.loads(flask.request.data)
     deployment_uuid = request.get('deployment_uuid')
     set_name = request.get('set_name', 'smoke')
@@ -314,46 +1941,145 @@ def run_verification():
     tempest_config = request.get('tempest_config', None)
     concurrency = request.get('concurrency', 1)
 
-    verification = objects.Verification(deployment_uuid=deployment_uuid)
-    verifier = tempest.Tempest(deployment_uuid, verification=verification,
-                               tempest_config=tempest_config)
+    verification = start_verification(deployment_uuid, set_name, regex,
+                                      tempest_config, concurrency)
 
-    if not verifier.is_installed():
-        flask.abort(500)
+    return flask.jsonify({"verification": verification._as_dict()}), 201
 
-    threading.Thread(target=verify,
-                     args=(verifier,
-                           verification.uuid,
-                           set_name,
-                           regex,
-                           concurrency)).start()
 
-    return flask.jsonify({"verification": verification._as_dict()}), 201
+@app.route("/verifications/<verification_uuid>/rerun", methods=['POST'])
+@idempotent
+def rerun_verification(verification_uuid):
+    request = json.loads(flask.request.data or "{}")
+
+    results = VERIFICATION_INDEX.get(verification_uuid)
+    if results is None:
+        flask.abort(404)
+
+    tests = request.get('tests') or [
+        test_id for test_id, (status, duration)
+        in results["tests"].items() if status == "fail"]
+    if not tests:
+        return flask.jsonify(
+            {"msg": "No failed tests in verification "
+                    "{0}".format(verification_uuid)})
+
+    # Params are kept on the node which ran the verification, in WORKDIR
+    params = load_verification_params(verification_uuid)
+    if not params and not ('tempest_config' in request and
+                           'concurrency' in request):
+        return flask.jsonify(
+            {"msg": "Params of verification {0} are unknown on this "
+                    "node, pass tempest_config and concurrency "
+                    "explicitly".format(verification_uuid)}), 409
+    tempest_config = request.get('tempest_config',
+                                 params.get('tempest_config'))
+    concurrency = request.get('concurrency', params.get('concurrency', 1))
+
+    # Without set name tempest runs only the tests matching the regex
+    verification = start_verification(results["deployment_uuid"], "",
+                                      tests_regex(tests), tempest_config,
+                                      concurrency,
+                                      rerun_of=verification_uuid)
+
+    verification = verification._as_dict()
+    verification["rerun_of"] = verification_uuid
+    verification["rerun_params"] = {"tempest_config": tempest_config,
+                                    "concurrency": concurrency}
+    return flask.jsonify({"verification": verification}), 201
+
+
+@app.route("/verifications/<verification_uuid>/abort", methods=['POST'])
+def abort_verification(verification_uuid):
+    soft = flask.request.args.get('soft', False) and True
+
+    job = JOBS.find("verification", verification_uuid)
+    if job is None:
+        flask.abort(404)
+
+    if JOBS.cancel(job):
+        db.verification_update(verification_uuid,
+                               {"status": consts.TaskStatus.ABORTED})
+    else:
+        # Released first, so the job can't start testr after the lookup
+        JOBS.release(job)
+        # testr stops at SIGINT and reports the tests run so far
+        for pid in runner_processes(job.pids):
+            try:
+                os.kill(pid, signal.SIGINT if soft else signal.SIGKILL)
+            except OSError:
+                pass
+
+    return flask.jsonify(
+        {"msg": "Verification {0} is {1}aborted".format(
+            verification_uuid, "soft " if soft else "")}), 202
 
 
 @app.route("/verifications", methods=['GET'])
 def list_verifications():
     return flask.jsonify(
-        {"verifications": [i._as_dict() for i in db.verification_list()]})
+        {"verifications": [i._as_dict()
+                           for i in paginate(db_models.Verification)]})
 
 
 @app.route("/verifications/<verification_uuid>", methods=['GET'])
 def get_verification(verification_uuid):
-    verification = db.verification_get(verification_uuid)
-    return flask.jsonify({"verification": verification._as_dict()})
+    def load():
+        verification = db.verification_get(verification_uuid)._as_dict()
+        verification["rerun_of"] = load_verification_params(
+            verification_uuid).get("rerun_of")
+        return ({"verification": verification},
+                verification["status"] in TASK_FINAL_STATUSES)
+
+    return cached_json("verification:{0}".format(verification_uuid), load)
 
 
 @app.route("/verifications/<verification_uuid>/result", methods=['GET'])
 def get_verification_results(verification_uuid):
     detailed = flask.request.args.get('detailed', False) and True
 
-    verification = db.verification_get(verification_uuid)
-    results = db.verification_result_get(verification_uuid)['data']
+    def load():
+        verification = db.verification_get(verification_uuid)
+        results = db.verification_result_get(verification_uuid)['data']
 
-    if detailed:
-        return flask.jsonify(results)
-    else:
-        return flask.jsonify(verification._as_dict())
+        final = verification["status"] in TASK_FINAL_STATUSES
+        if detailed:
+            return results, final
+        else:
+            return verification._as_dict(), final
+
+    return cached_json("verification_result:{0}:{1}".format(
+        verification_uuid, int(detailed)), load)
+
+
+@app.route("/verifications/<verification_uuid>/diff/<other_uuid>",
+           methods=['GET'])
+def diff_verifications(verification_uuid, other_uuid):
+    if (VERIFICATION_INDEX.get(verification_uuid) is None or
+            VERIFICATION_INDEX.get(other_uuid) is None):
+        flask.abort(404)
+    return flask.jsonify(
+        {"verification_diff": VERIFICATION_INDEX.diff(verification_uuid,
+                                                      other_uuid)})
+
+
+@app.route("/deployments/<deployment_uuid>/verifications/flaky",
+           methods=['GET'])
+def get_flaky_tests(deployment_uuid):
+    limit = int(flask.request.args.get('limit', 20))
+    VERIFICATION_INDEX.refresh()
+    return flask.jsonify(
+        {"flaky_tests": VERIFICATION_INDEX.flaky(deployment_uuid, limit)})
+
+
+@app.route("/deployments/<deployment_uuid>/verifications/slowest",
+           methods=['GET'])
+def get_slowest_tests(deployment_uuid):
+    limit = int(flask.request.args.get('limit', 20))
+    VERIFICATION_INDEX.refresh()
+    return flask.jsonify(
+        {"slowest_tests": VERIFICATION_INDEX.slowest(deployment_uuid,
+                                                     limit)})
 
 
 @app.route("/verifications/<verification_uuid>/report", methods=['GET'])
@@ -376,6 +2102,8 @@ def get_verification_report(verification_uuid):
 
 
 def main():
+    global SERVING_AT
+
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s - %(levelname)s - %(name)s '
                                '- %(threadName)s - %(message)s',
@@ -389,7 +2117,21 @@ def main():
     console.setFormatter(formatter)
     logging.getLogger('').addHandler(console)
 
-    plugins.load()
+    # Route output and track subprocesses of the threads running jobs
+    sys.stdout = STDOUT
+    subprocess.Popen = TrackedPopen
+
+    if AGENT_PORT:
+        start_agent_check(AGENT_PORT)
+
+    if LAZY_LOAD:
+        warm_up = threading.Thread(target=LOADER.warm_up, name="warm-up")
+        warm_up.daemon = True
+        warm_up.start()
+    else:
+        LOADER.load()
+
+    SERVING_AT = time.time()
     app.run("0.0.0.0", 8000, debug=True, use_reloader=False)
 
 
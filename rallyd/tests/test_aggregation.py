@@ -0,0 +1,76 @@
+import unittest
+
+import numpy
+
+import rallyd
+
+nan = numpy.nan
+
+
+class AggregationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Keep the lazy proxy from loading Rally for plain NumPy work
+        self.addCleanup(setattr, rallyd, "np", rallyd.np)
+        rallyd.np = numpy
+
+    def test_aggregate_durations(self):
+        # Columns: whole iteration, an action, an action never measured
+        durations = numpy.array([[1.0, 0.5, nan],
+                                 [2.0, nan, nan],
+                                 [3.0, 1.5, nan],
+                                 [4.0, 1.0, nan]])
+
+        stats = rallyd.aggregate_durations(durations)
+
+        self.assertEqual((3, len(rallyd.STAT_FIELDS)), stats.shape)
+        total = dict(zip(rallyd.STAT_FIELDS, stats[0]))
+        self.assertEqual(1.0, total["min"])
+        self.assertEqual(2.5, total["median"])
+        self.assertAlmostEqual(3.7, total["p90"])
+        self.assertAlmostEqual(3.85, total["p95"])
+        self.assertEqual(4.0, total["max"])
+        self.assertEqual(2.5, total["avg"])
+        action = dict(zip(rallyd.STAT_FIELDS, stats[1]))
+        self.assertEqual(0.5, action["min"])
+        self.assertEqual(1.0, action["median"])
+        self.assertEqual(1.0, action["avg"])
+        self.assertTrue(numpy.isnan(stats[2]).all())
+
+    def test_aggregate_durations_without_iterations(self):
+        stats = rallyd.aggregate_durations(numpy.empty((0, 2)))
+
+        self.assertEqual((2, len(rallyd.STAT_FIELDS)), stats.shape)
+        self.assertTrue(numpy.isnan(stats).all())
+
+    def test_downsample_averages_buckets(self):
+        timestamps = numpy.arange(6, dtype=float)
+        durations = numpy.array([[1.0], [3.0], [nan], [5.0], [2.0], [4.0]])
+
+        bucket_timestamps, means = rallyd.downsample(timestamps, durations,
+                                                     3)
+
+        self.assertEqual([0.5, 2.5, 4.5], bucket_timestamps.tolist())
+        # Failed iterations are left out of the averages
+        self.assertEqual([[2.0], [5.0], [3.0]], means.tolist())
+
+    def test_downsample_keeps_short_series(self):
+        timestamps = numpy.array([1.0, 2.0])
+        durations = numpy.array([[1.0], [nan]])
+
+        bucket_timestamps, means = rallyd.downsample(timestamps, durations,
+                                                     10)
+
+        self.assertEqual([1.0, 2.0], bucket_timestamps.tolist())
+        self.assertEqual(1.0, means[0, 0])
+        self.assertTrue(numpy.isnan(means[1, 0]))
+
+    def test_downsample_empty_series(self):
+        timestamps = numpy.array([])
+        durations = numpy.empty((0, 1))
+
+        bucket_timestamps, means = rallyd.downsample(timestamps, durations,
+                                                     10)
+
+        self.assertEqual(0, len(bucket_timestamps))
+        self.assertEqual(0, len(means))
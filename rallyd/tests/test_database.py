@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from oslo_db import options as db_options
+import sqlalchemy
+
+import rallyd
+
+
+class ConfigureDatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+        # Stands for the [database] section of rally.conf
+        self.rally_connection = "sqlite:///" + os.path.join(self.tmp_dir,
+                                                            "rally.sqlite")
+        config_file = os.path.join(self.tmp_dir, "rally.conf")
+        with open(config_file, "w") as f:
+            f.write("[database]\nconnection = {0}\n".format(
+                self.rally_connection))
+
+        db_options.set_defaults(rallyd.CONF)
+        rallyd.CONF([], project="rally", default_config_files=[config_file])
+        self.addCleanup(rallyd.CONF.reset)
+        self.addCleanup(sqlalchemy.event.remove, sqlalchemy.engine.Engine,
+                        "connect", rallyd.tune_sqlite)
+
+    def test_sqlite_uses_wal_and_busy_timeout(self):
+        rallyd.CONF.set_override("sqlite_busy_timeout", 1234, group="rallyd")
+        rallyd.configure_database()
+
+        engine = sqlalchemy.create_engine(rallyd.CONF.database.connection)
+        connection = engine.connect()
+        self.addCleanup(connection.close)
+        self.assertEqual(
+            "wal", connection.execute("PRAGMA journal_mode").scalar())
+        self.assertEqual(
+            1234, connection.execute("PRAGMA busy_timeout").scalar())
+
+    def test_rally_connection_is_kept(self):
+        rallyd.configure_database()
+
+        self.assertEqual(self.rally_connection,
+                         rallyd.CONF.database.connection)
+
+    def test_database_connection_overrides_rally_connection(self):
+        rallyd.CONF.set_override("database_connection",
+                                 "postgresql://rally@db/rally",
+                                 group="rallyd")
+        rallyd.configure_database()
+
+        self.assertEqual("postgresql://rally@db/rally",
+                         rallyd.CONF.database.connection)
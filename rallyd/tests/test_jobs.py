@@ -0,0 +1,121 @@
+import threading
+import time
+import unittest
+
+import rallyd
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("Timed out waiting for the job registry")
+        time.sleep(0.01)
+
+
+class JobRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rallyd.CONF([], project="rally", default_config_files=[])
+        self.addCleanup(rallyd.CONF.reset)
+        for name, value in (("max_running_jobs", 1),
+                            ("max_queued_jobs", 1),
+                            ("max_jobs_per_deployment", 0),
+                            ("max_jobs_per_client", 0)):
+            rallyd.CONF.set_override(name, value, group="rallyd")
+
+        self.addCleanup(setattr, rallyd.LOADER, "status",
+                        rallyd.LOADER.status)
+        rallyd.LOADER.status = "ready"
+        self.memory_headroom = 1.0
+        self.addCleanup(setattr, rallyd, "node_load", rallyd.node_load)
+        rallyd.node_load = lambda: {"memory_headroom": self.memory_headroom}
+
+        self.jobs = rallyd.JobRegistry()
+        self.events = []
+        self.addCleanup(self.stop_jobs)
+
+    def stop_jobs(self):
+        for event in self.events:
+            event.set()
+        wait_for(lambda: not self.jobs.jobs)
+
+    def start(self, job_uuid, deployment_uuid=None, client=None):
+        """Admit and start a job which runs until its event is set."""
+        event = threading.Event()
+        self.events.append(event)
+        job = self.jobs.admit("task", deployment_uuid, client)
+        return self.jobs.start(job, job_uuid, event.wait, ()), event
+
+    def test_queued_job_runs_when_slot_frees(self):
+        first, first_done = self.start("first")
+        second, second_done = self.start("second")
+        wait_for(lambda: first.status == "running")
+
+        self.assertEqual("queued", second.status)
+        first_done.set()
+        wait_for(lambda: second.status == "running")
+        self.assertEqual("done", first.status)
+
+    def test_saturated_node_rejects_jobs(self):
+        first, _ = self.start("first")
+        wait_for(lambda: first.status == "running")
+        self.start("second")
+
+        with self.assertRaises(rallyd.AdmissionError) as ctx:
+            self.jobs.admit("task")
+        self.assertEqual(503, ctx.exception.code)
+
+    def test_low_memory_rejects_jobs(self):
+        self.memory_headroom = 0.01
+
+        with self.assertRaises(rallyd.AdmissionError) as ctx:
+            self.jobs.admit("task")
+        self.assertEqual(503, ctx.exception.code)
+
+    def test_per_deployment_and_client_limits(self):
+        rallyd.CONF.set_override("max_running_jobs", 10, group="rallyd")
+        rallyd.CONF.set_override("max_jobs_per_deployment", 1,
+                                 group="rallyd")
+        rallyd.CONF.set_override("max_jobs_per_client", 1, group="rallyd")
+        self.start("first", deployment_uuid="d1", client="c1")
+
+        for deployment_uuid, client in (("d1", "c2"), ("d2", "c1")):
+            with self.assertRaises(rallyd.AdmissionError) as ctx:
+                self.jobs.admit("task", deployment_uuid, client)
+            self.assertEqual(429, ctx.exception.code)
+        self.start("second", deployment_uuid="d2", client="c2")
+
+    def test_admission_drops_jobs_never_started(self):
+        with self.jobs.admission("task") as job:
+            pass
+
+        self.assertEqual("done", job.status)
+        self.assertEqual(0, len(self.jobs.jobs))
+
+    def test_cancel_queued_job(self):
+        first, _ = self.start("first")
+        second, _ = self.start("second")
+        wait_for(lambda: first.status == "running")
+
+        self.assertFalse(self.jobs.cancel(first))
+        self.assertTrue(self.jobs.cancel(second))
+        wait_for(lambda: second.status == "done")
+        self.assertEqual("running", first.status)
+        self.assertEqual({"running": 1, "queued": 0, "task": 1},
+                         dict(self.jobs.counts()))
+
+    def test_release_gives_slot_to_queued_job(self):
+        first, first_done = self.start("first")
+        second, _ = self.start("second")
+        wait_for(lambda: first.status == "running")
+
+        self.jobs.release(first)
+        wait_for(lambda: second.status == "running")
+        self.assertEqual("aborting", first.status)
+        # Aborting jobs don't count against the queue
+        self.start("third")
+
+        first_done.set()
+        wait_for(lambda: first.status == "done")
+        self.assertEqual(1, self.jobs.counts()["running"])
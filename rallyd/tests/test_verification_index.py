@@ -0,0 +1,77 @@
+import datetime
+import itertools
+import unittest
+
+import rallyd
+
+
+def created_at(day):
+    return datetime.datetime(2016, 1, day)
+
+
+class AddOutcomeTestCase(unittest.TestCase):
+
+    def add_outcomes(self, outcomes):
+        test = {"flips": 0, "outcomes": []}
+        for day, status in outcomes:
+            rallyd.VerificationIndex.add_outcome(test, created_at(day),
+                                                 status)
+        return test
+
+    def test_flips_are_counted_in_creation_order(self):
+        test = self.add_outcomes([(1, "pass"), (2, "fail"), (3, "pass")])
+
+        self.assertEqual(2, test["flips"])
+        self.assertEqual(["pass", "fail", "pass"],
+                         [status for _, status in test["outcomes"]])
+
+    def test_flips_do_not_depend_on_indexing_order(self):
+        outcomes = [(1, "pass"), (2, "pass"), (3, "fail"), (4, "fail"),
+                    (5, "pass")]
+        for order in itertools.permutations(outcomes):
+            test = self.add_outcomes(order)
+            self.assertEqual(2, test["flips"])
+            self.assertEqual(
+                [(created_at(day), status) for day, status in outcomes],
+                test["outcomes"])
+
+    def test_outcome_between_flipping_neighbours(self):
+        # pass, fail: one flip; a pass between them moves the flip
+        test = self.add_outcomes([(1, "pass"), (3, "fail"), (2, "pass")])
+        self.assertEqual(1, test["flips"])
+
+        # pass, pass: no flip; a fail between them makes two
+        test = self.add_outcomes([(1, "pass"), (3, "pass"), (2, "fail")])
+        self.assertEqual(2, test["flips"])
+
+
+class VerificationIndexStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = rallyd.VerificationIndex()
+        stats = self.index.deployments["deployment"]
+        for test_id, outcomes, time in (
+                ("stable", ["pass"] * 4, 8.0),
+                ("flaky", ["pass", "fail"] * 2, 6.0),
+                ("broken", ["pass"] + ["fail"] * 3, 1.0)):
+            test = stats[test_id] = {
+                "runs": len(outcomes), "pass": outcomes.count("pass"),
+                "fail": outcomes.count("fail"), "skip": 0, "flips": 0,
+                "outcomes": [], "timed_runs": outcomes.count("pass"),
+                "time": time}
+            for day, status in enumerate(outcomes, 1):
+                self.index.add_outcome(test, created_at(day), status)
+
+    def test_flaky_ranks_by_flip_rate(self):
+        flaky = self.index.flaky("deployment", 10)
+
+        self.assertEqual(["flaky", "broken"], [t["test"] for t in flaky])
+        self.assertEqual(1.0, flaky[0]["flip_rate"])
+        self.assertEqual("fail", flaky[0]["last"])
+        self.assertNotIn("outcomes", flaky[0])
+
+    def test_slowest_ranks_by_average_time(self):
+        slowest = self.index.slowest("deployment", 2)
+
+        self.assertEqual(["flaky", "stable"], [t["test"] for t in slowest])
+        self.assertEqual(3.0, slowest[0]["avg_time"])
@@ -3,7 +3,7 @@
 COUNT=1
 for ip in ${BACKEND_IPS}
 do
-    sudo sed -i "\$aserver backend${COUNT} ${ip} check" /etc/haproxy/haproxy.cfg 
+    sudo sed -i "\$aserver backend${COUNT} ${ip} check weight 100 agent-check agent-port ${RALLYD_AGENT_PORT:-8001} agent-inter 2s" /etc/haproxy/haproxy.cfg
     COUNT=$((${COUNT} + 1))
 done
 